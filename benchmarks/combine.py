@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Benchmark ``fullerene.metric.combine`` over synthetic metric path sets.
+
+Run from the repository root:
+
+    python benchmarks/combine.py
+
+For each input size, reports the best of several runs in total and per
+path; per-path cost should stay roughly flat as inputs grow.
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fullerene.metric import combine
+
+
+SIZES = (100, 1000, 10000, 100000)
+
+# (description, path generator, expansions)
+SCENARIOS = (
+    ("1 wildcard, combined",
+        lambda n: ["df.disk%d.free.value" % i for i in range(n)],
+        []),
+    ("1 wildcard, expanded",
+        lambda n: ["df.disk%d.free.value" % i for i in range(n)],
+        [1]),
+    ("2 wildcards, 1st expanded",
+        lambda n: [
+            "interface.eth%d.if_octets.%s" % (i, x)
+            for i in range(n / 2) for x in ("rx", "tx")
+        ],
+        [1]),
+    ("2 sparse wildcards, both expanded",
+        lambda n: ["cpu.%d.cpu.state%d" % (i, i % 7) for i in range(n)],
+        [1, 3]),
+)
+
+
+def main(repeat=3):
+    print "%-36s %8s %12s %12s" % ("scenario", "paths", "total (ms)",
+        "per path (us)")
+    for desc, generate, expansions in SCENARIOS:
+        for size in SIZES:
+            paths = generate(size)
+            runs = timeit.repeat(
+                lambda: combine(paths, expansions, True),
+                repeat=repeat,
+                number=1
+            )
+            best = min(runs)
+            print "%-36s %8d %12.2f %12.2f" % (desc, len(paths), best * 1e3,
+                best * 1e6 / len(paths))
+
+
+if __name__ == '__main__':
+    main()
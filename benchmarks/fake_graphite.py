@@ -0,0 +1,171 @@
+"""
+Minimal stand-in for a Graphite webapp, serving a synthetic metric tree.
+
+Implements just enough of Graphite's HTTP API for Fullerene:
+/metrics/expand/, /metrics/find/, /metrics/index.json and /render/ (both
+images and ``format=json``), with optional artificial latency per request.
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import defaultdict
+from SocketServer import ThreadingMixIn
+import json
+import os
+import sys
+import threading
+import time
+import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fullerene.index import LEAF, MetricIndex
+
+
+# Smallest valid PNG (1x1 transparent pixel), returned for image renders
+PNG = (
+    "\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08"
+    "\x06\x00\x00\x00\x1f\x15\xc4\x89\x00\x00\x00\rIDATx\x9cc\xf8\x0f\x00"
+    "\x00\x01\x01\x00\x05\x18\xd8N\x00\x00\x00\x00IEND\xaeB`\x82"
+)
+
+
+def synthetic_tree(hosts=10, metrics=4, domains=2):
+    """
+    Return collectd-style metric paths for ``hosts`` hosts.
+
+    ``metrics`` scales the number of per-host devices (disks, interfaces,
+    CPUs) and thus metric paths per host.
+    """
+    paths = []
+    for number in range(hosts):
+        host = "host%d_domain%d_com" % (number, number % domains)
+        for load in ("shortterm", "midterm", "longterm"):
+            paths.append("%s.load.load.%s" % (host, load))
+        paths.append("%s.memory.memory.free.value" % host)
+        for device in range(metrics):
+            paths.append("%s.df.disk%d.df_complex.free.value" % (host, device))
+            for op in ("read", "write"):
+                paths.append("%s.disk.xvd%d.disk_octets.%s" % (host, device, op))
+            for op in ("rx", "tx"):
+                paths.append("%s.interface.if_octets.eth%d.%s" % (
+                    host, device, op))
+            for state in ("user", "system"):
+                paths.append("%s.cpu.%d.cpu.%s.value" % (host, device, state))
+    return paths
+
+
+class FakeGraphite(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, paths, latency=0.0, points=240, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.paths = paths
+        self.index = MetricIndex(None, paths=paths)
+        self.latency = latency
+        self.points = points
+        self.calls = defaultdict(int)
+        self._lock = threading.Lock()
+
+    @property
+    def uri(self):
+        return "http://%s:%d" % self.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def count(self, endpoint):
+        with self._lock:
+            self.calls[endpoint] += 1
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers & body are written separately; don't let Nagle stall them
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        if url.path == "/metrics/expand/":
+            server.count('expand')
+            leaves_only = params.get('leavesOnly', ['0'])[0] == '1'
+            results = set()
+            for query in params.get('query', []):
+                results.update(server.index.expand(query, leaves_only))
+            self.send_json({'results': sorted(results)})
+        elif url.path == "/metrics/find/":
+            server.count('find')
+            query = params.get('query', [''])[0]
+            nodes = []
+            for path in server.index.expand(query):
+                children = self.children(path)
+                nodes.append({
+                    'id': path,
+                    'text': path.split('.')[-1],
+                    'leaf': int(children is None or LEAF in children),
+                    'expandable': int(bool(children)),
+                })
+            self.send_json(nodes)
+        elif url.path == "/metrics/index.json":
+            server.count('index')
+            self.send_json(server.paths)
+        elif url.path == "/render/":
+            if params.get('format', [''])[0] == 'json':
+                server.count('render_json')
+                self.send_json(self.series(params.get('target', [])))
+            else:
+                server.count('render')
+                self.send("image/png", PNG)
+        else:
+            self.send_error(404)
+
+    def children(self, path):
+        node = self.server.index.root
+        for part in path.split('.'):
+            node = node[part]
+        return node
+
+    def series(self, targets):
+        now = int(time.time())
+        step = 60
+        results = []
+        for target in targets:
+            for path in self.server.index.expand(target):
+                datapoints = [
+                    [None if i % 17 == 0 else float(i % 50), now - i * step]
+                    for i in reversed(range(self.server.points))
+                ]
+                results.append({'target': path, 'datapoints': datapoints})
+        return results
+
+    def send_json(self, data):
+        self.send("application/json", json.dumps(data))
+
+    def send(self, content_type, body):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+if __name__ == '__main__':
+    server = FakeGraphite(synthetic_tree(), port=8081).start()
+    print "Fake Graphite listening on %s" % server.uri
+    while True:
+        time.sleep(60)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+Benchmark Fullerene's page routes against a fake Graphite.
+
+Starts a local stand-in Graphite (see ``fake_graphite.py``) serving a
+synthetic tree of N hosts x M devices, points a generated config at it, and
+drives each route through the Flask app. For each route, reports latency
+percentiles, upstream Graphite calls per request (by endpoint) and peak
+process memory. Run from the repository root, e.g.:
+
+    python benchmarks/routes.py --hosts 40 --metrics 8 --latency 0.005
+"""
+import argparse
+import os
+import resource
+import socket
+import sys
+import tempfile
+import time
+
+
+CONFIG = """
+graphite_uris:
+  internal: http://127.0.0.1:%(port)d
+periods:
+  recent: -4hours
+  week: -7days
+metrics:
+  free_disk_space:
+    title: Free Disk Space
+    path: df.*.df_complex.free.value
+    exclude: [disk0]
+    expand: all
+  cpu:
+    title: CPU usage
+    path: "group(sumSeries(%%s.cpu.*.cpu.system.value),sumSeries(%%s.cpu.*.cpu.user.value))"
+  overview_load:
+    title: Load, all hosts
+    path: "sumSeries(*.load.load.shortterm)"
+    raw: true
+metric_groups:
+  baseline:
+    - free_disk_space
+    - cpu
+    - disk.*.disk_octets.{read,write}
+    - interface.if_octets.*.{rx,tx}
+    - load.load.*
+    - memory.memory.free.value
+collections:
+  bench:
+    title: Benchmark
+    groups:
+      project:
+        title: Every host
+        hosts: [%(hosts)s]
+        metrics:
+          - free_disk_space
+          - load.load.*
+          - interface.if_octets.*.{rx,tx}
+        overview:
+          - overview_load
+"""
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+def peak_memory_mb():
+    # ru_maxrss is in kilobytes on Linux (bytes on OS X)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak / 1024.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--hosts', type=int, default=20)
+    parser.add_argument('--metrics', type=int, default=4,
+        help="Devices (disks, interfaces, CPUs) per host")
+    parser.add_argument('--latency', type=float, default=0.0,
+        help="Seconds of artificial latency per upstream request")
+    parser.add_argument('--requests', type=int, default=20,
+        help="Requests per route")
+    args = parser.parse_args()
+
+    # Config must exist before fullerene is first imported
+    port = free_port()
+    hostnames = [
+        "host%d.domain%d.com" % (number, number % 2)
+        for number in range(args.hosts)
+    ]
+    fd, path = tempfile.mkstemp(suffix='.yml')
+    with os.fdopen(fd, 'w') as config:
+        config.write(CONFIG % {'port': port, 'hosts': ", ".join(hostnames)})
+    os.environ['FULLERENE_CONFIG'] = path
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+    from fake_graphite import FakeGraphite, synthetic_tree
+    import fullerene
+
+    tree = synthetic_tree(args.hosts, args.metrics)
+    server = FakeGraphite(tree, latency=args.latency, port=port).start()
+    client = fullerene.app.test_client()
+    routes = (
+        ('index', '/'),
+        ('domain', '/by_domain/domain0.com/'),
+        ('host', '/by_domain/domain0.com/host0/baseline/recent/'),
+        ('group', '/bench/project/'),
+        ('group_metric', '/bench/project/free_disk_space/'),
+        ('render', '/render/?target=host0_domain0_com.load.load.shortterm'),
+    )
+    print "%d hosts, %d metric paths, %.1fms upstream latency\n" % (
+        args.hosts, len(tree), args.latency * 1000)
+    print "%-13s %8s %8s %8s %8s %8s  %s" % ("route", "p50 ms", "p90 ms",
+        "p99 ms", "max ms", "peak MB", "upstream calls/request")
+    try:
+        for name, url in routes:
+            server.reset()
+            timings = []
+            for _ in range(args.requests):
+                start = time.time()
+                # Reads any streamed body in full, then closes the response
+                # (which e.g. ends its render flight, as a server would)
+                response = client.get(url, buffered=True)
+                timings.append((time.time() - start) * 1000)
+                if response.status_code != 200:
+                    raise SystemExit("%s returned %s" % (url,
+                        response.status_code))
+            calls = ", ".join(
+                "%s=%.1f" % (endpoint, count / float(args.requests))
+                for endpoint, count in sorted(server.calls.items())
+            ) or "none"
+            print "%-13s %8.1f %8.1f %8.1f %8.1f %8.1f  %s" % (
+                name,
+                percentile(timings, 50),
+                percentile(timings, 90),
+                percentile(timings, 99),
+                max(timings),
+                peak_memory_mb(),
+                calls,
+            )
+    finally:
+        server.shutdown()
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,23 @@
 from collections import defaultdict
+import functools
 import operator
 import os
+import time
 
-import requests
 import flask
+from werkzeug.local import LocalProxy
+from werkzeug.wsgi import ClosingIterator
 import yaml
 
+from cache import render_ttl, request_key, uncacheable
+from concurrency import Broadcast, SingleFlight
 from metric import Metric
-from graphite import Graphite
-from config import Config
+from proxy import (cacheable_headers, discard, downstream_headers, stream,
+    stream_file, upstream_headers)
+from graphite import WINDOW_PARAMS
+import instrument
+from profiling import Profile
+from config import ConfigFile
 from utils import dots, sliced
 
 
@@ -17,12 +26,31 @@ from utils import dots, sliced
 #
 
 ROOT = os.path.join(os.path.dirname(__file__), "..")
-CONFIG = os.path.join(ROOT, "config.yml")
-with open(CONFIG) as fd:
-    config = Config(fd.read())
+CONFIG = os.environ.get(
+    'FULLERENE_CONFIG',
+    os.path.join(ROOT, "config.yml")
+)
+config_file = ConfigFile(CONFIG)
+config_file.watch()
+
+def current_config():
+    """
+    The config snapshot for this request, or the latest one outside requests.
+    """
+    if flask.has_request_context():
+        pinned = getattr(flask.g, 'config', None)
+        if pinned is not None:
+            return pinned
+    return config_file.config
+
+# Stays on one snapshot for a whole request, even if reloaded meanwhile
+config = LocalProxy(current_config)
 
 app = flask.Flask(__name__)
 
+# In-progress /render/ requests, for sharing among identical requests
+render_flights = SingleFlight()
+
 
 #
 # Template filters
@@ -56,10 +84,238 @@ def composer(graph):
         return config.external_graphite + "/composer/" + graph.querystring
 
 
+@app.context_processor
+def page_options():
+    return {'defer_stats': config.defer_stats}
+
+
+#
+# Helpers
+#
+
+def render_page(template, **context):
+    """
+    ``flask.render_template``, timed as the request's "template" phase.
+    """
+    with instrument.timed('template'):
+        return flask.render_template(template, **context)
+
+def streaming():
+    """
+    Should this request's page be streamed? See ``stream_page``.
+    """
+    return config.streaming and getattr(flask.g, 'profile', None) is None
+
+def stream_page(template, **context):
+    """
+    Like ``render_page``, but sends the page out piece by piece as it renders.
+
+    The page's shell and navigation reach the browser (which can then start
+    loading graph images) while later parts of the page are still waiting on
+    Graphite. Since headers are sent first, errors part way through can only
+    truncate the page rather than turn it into an error page.
+    """
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template).stream(context)
+    stream.enable_buffering(5)
+    return flask.Response(flask.stream_with_context(stream))
+
+def cached_page(view):
+    """
+    Serve ``view`` from the page cache, if one is configured.
+
+    Pages are keyed by URL and kept for as long as graphs of their period
+    (or the default period) would be; see ``cache.PageCache``.
+    """
+    @functools.wraps(view)
+    def cached(**kwargs):
+        pages = config.page_cache
+        profiling = getattr(flask.g, 'profile', None) is not None
+        if pages is None or profiling or config.streaming:
+            return view(**kwargs)
+        request = flask.request
+        params = dict(config.defaults)
+        if 'period' in kwargs:
+            params['from'] = config.periods.get(kwargs['period'],
+                kwargs['period'])
+        render = lambda: view(**kwargs)
+        return pages.get(
+            request_key(request.args, request.path),
+            render_ttl(params, *config.render_ttl),
+            render,
+            flask.copy_current_request_context(render),
+        )
+    return cached
+
+def fetch_stats(graphs, prefetch=False):
+    """
+    Fetch stats for a page's ``graphs``, unless the browser is to do so.
+
+    With ``prefetch=True``, stats are only started fetching in the background.
+    With ``defer_stats`` on, nothing is fetched: pages leave their stats
+    tables to be filled in via the ``/stats/`` endpoint. Pages with stats
+    which failed to load aren't put in the page cache.
+    """
+    if config.defer_stats:
+        return
+    if prefetch:
+        config.graphite.prefetch_stats(graphs)
+    elif not config.graphite.fetch_stats(graphs):
+        uncacheable()
+
+def prefetched(build):
+    """
+    Yield the Graphs returned by ``build()``, their stats fetching meanwhile.
+
+    Nothing is built until the first graph is asked for, so a streamed page
+    gets its header out before waiting on Graphite.
+    """
+    graphs = build()
+    fetch_stats(graphs, prefetch=True)
+    for graph in graphs:
+        yield graph
+
+def lazily(build):
+    """
+    Yield the items of ``build()``, which isn't called until the first one is
+    asked for; see ``prefetched``.
+    """
+    for item in build():
+        yield item
+
+def overview_graphs(group, gname, prefetch=False):
+    """
+    Return (metric, graphs) pairs for ``group``'s overview, with stats fetched.
+
+    With ``prefetch=True`` (i.e. for streamed pages) nothing is built, and
+    Graphite not contacted, until the pairs are first iterated over.
+    """
+    def build():
+        overview = [
+            (metric, metric.graphs(group=gname))
+            for metric in group.get('overview', [])
+        ]
+        fetch_stats(
+            reduce(operator.add, [graphs for _, graphs in overview], []),
+            prefetch
+        )
+        return overview
+    return lazily(build) if prefetch else build()
+
+
+#
+# Configuration
+#
+
+@app.before_request
+def pin_config():
+    flask.g.config = config_file.config
+
+
+#
+# Instrumentation
+#
+
+@app.before_request
+def start_timings():
+    instrument.activate(instrument.Timings(flask.request.endpoint))
+
+@app.after_request
+def add_server_timing(response):
+    timings = instrument.current()
+    if timings is not None:
+        response.headers['Server-Timing'] = timings.server_timing()
+        instrument.registry.observe_request(
+            timings.route,
+            time.time() - timings.start
+        )
+    return response
+
+@app.teardown_request
+def stop_timings(exception):
+    instrument.activate(None)
+
+
+#
+# Profiling
+#
+
+@app.before_request
+def start_profile():
+    """
+    Profile this request if profiling is enabled and asked for.
+    """
+    options = config.profiling
+    request = flask.request
+    if options.get('enabled') and options.get('param', '_profile') in request.args:
+        flask.g.profile = Profile(request.endpoint)
+
+@app.after_request
+def finish_profile(response):
+    """
+    Store the request's profile on disk, or return it in place of the page.
+    """
+    profile = getattr(flask.g, 'profile', None)
+    if profile is None:
+        return response
+    profile.stop()
+    options = config.profiling
+    if options.get('directory'):
+        response.headers['X-Profile'] = profile.dump(options['directory'])
+        return response
+    return flask.Response(
+        profile.report(instrument.current(), options.get('limit', 40)),
+        mimetype='text/plain'
+    )
+
+
 #
 # Routes
 #
 
+@app.route('/_metrics')
+def metrics():
+    """
+    Process-wide request/upstream timings, for Prometheus to scrape.
+    """
+    return flask.Response(
+        instrument.registry.prometheus(),
+        mimetype='text/plain; version=0.0.4'
+    )
+
+@app.route('/stats/')
+def stats():
+    """
+    Stats for one or more targets sharing a time window, as JSON.
+
+    Takes ``target`` (repeatable) plus any of ``from``/``until``/``width``,
+    and returns ``{"stats": [...]}`` holding one list of series per target,
+    in order. Datapoints are left out. Used by pages with ``defer_stats`` on
+    to fill in their stats tables once they've loaded; responses may be
+    cached for as long as a graph of the same period would be, unless any
+    target's render failed or timed out.
+    """
+    args = flask.request.args
+    window = dict(
+        (x, args[x]) for x in WINDOW_PARAMS + ('width',) if x in args
+    )
+    # Failed renders come back as None, rather than as an empty list
+    results = config.graphite.stats_batch([
+        dict(window, target=target) for target in args.getlist('target')
+    ], default=lambda: None)
+    response = flask.jsonify(stats=[
+        [{'target': series.target, 'stats': series.stats}
+            for series in result or ()]
+        for result in results
+    ])
+    if None in results:
+        # Don't let anybody hang on to blanks for a whole period
+        response.cache_control.no_store = True
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = render_ttl(args, *config.render_ttl)
+    return response
+
 @app.route('/')
 def index():
     collections = [
@@ -74,14 +330,14 @@ def index():
             key=lambda x: x[0]
         )
     )
-    return flask.render_template(
+    return render_page(
         'index.html',
         collections=collections
     )
 
 @app.route('/by_domain/<domain>/')
 def domain(domain):
-    return flask.render_template(
+    return render_page(
         'domain.html',
         domain=domain,
         hosts=config.graphite.hosts_for_domain(domain),
@@ -89,28 +345,34 @@ def domain(domain):
     )
 
 @app.route('/<collection>/<group>/')
+@cached_page
 def group(collection, group):
     # Setup
     cname = collection
     gname = group
-    collection = config.collections[collection]
-    group = collection['groups'][group]
-    return flask.render_template(
+    with instrument.timed('config'):
+        collection = config.collections[collection]
+        group = collection['groups'][group]
+    stream = streaming()
+    return (stream_page if stream else render_page)(
         'collection_group.html',
         cname=cname,
         group=group,
         gname=gname,
-        metrics=group['metrics']
+        metrics=group['metrics'],
+        overview=overview_graphs(group, gname, prefetch=stream),
     )
 
 @app.route('/<collection>/<group>/<metric>/')
+@cached_page
 def group_metric(collection, group, metric):
     # Basic setup
     period = '-4hours'
     cname = collection
-    collection = config.collections[collection]
     gname = group
-    group = collection['groups'][group]
+    with instrument.timed('config'):
+        collection = config.collections[collection]
+        group = collection['groups'][group]
     # Slug => metric object
     mobj = None
     for m in group['metrics']:
@@ -139,7 +401,8 @@ def group_metric(collection, group, metric):
         'hideXAxis': True,
         'from': period,
     }
-    return flask.render_template(
+    stream = streaming()
+    return (stream_page if stream else render_page)(
         'group.html',
         collection=collection,
         group=group,
@@ -151,26 +414,36 @@ def group_metric(collection, group, metric):
         thumbnail_opts=thumbnail_opts,
         period=period,
         parent=parent,
-        gname=gname
+        gname=gname,
+        overview=overview_graphs(group, gname, prefetch=stream),
     )
 
 @app.route('/by_domain/<domain>/<host>/<metric_group>/<period>/')
+@cached_page
 def host(domain, host, metric_group, period):
-    # Get metric objects for this group
-    raw_metrics = config.groups[metric_group].values()
-    # Filter period value through defined aliases
-    kwargs = {'from': config.periods.get(period, period)}
+    with instrument.timed('config'):
+        # Get metric objects for this group
+        raw_metrics = config.groups[metric_group].values()
+        # Filter period value through defined aliases
+        kwargs = {'from': config.periods.get(period, period)}
     # Generate graph objects from each metric, based on hostname context
     graphite_host = host + '_' + domain.replace('.', '_')
-    graphs = map(lambda m: m.graphs(graphite_host, **kwargs), raw_metrics)
-    merged = reduce(operator.add, graphs, [])
+    def host_graphs():
+        graphs = map(lambda m: m.graphs(graphite_host, **kwargs), raw_metrics)
+        return reduce(operator.add, graphs, [])
+    stream = streaming()
+    if stream:
+        merged = prefetched(host_graphs)
+    else:
+        merged = host_graphs()
+        fetch_stats(merged)
     # Set up metric group nav
     metric_groups = map(
         lambda x: (x, flask.url_for('host', domain=domain, metric_group=x,
             host=host, period=period)),
         config.metric_groups
     )
-    return flask.render_template(
+    return (stream_page if stream else render_page)(
         'host.html',
         domain=domain,
         host=host,
@@ -183,6 +456,89 @@ def host(domain, host, metric_group, period):
 
 @app.route('/render/')
 def render():
-    uri = config.graphite.uri + "/render/"
-    response = requests.get(uri, params=flask.request.args)
-    return flask.Response(response=response.raw, headers=response.headers)
+    """
+    Stream a render from Graphite through to the client.
+
+    Bodies are passed through chunk by chunk without decoding, and, if a
+    render cache is configured, written to it along the way. Identical
+    renders requested while one is already in progress share its response
+    rather than each going to Graphite.
+    """
+    request = flask.request
+    args = request.args
+    fetch_headers = upstream_headers(request.headers)
+    cache = config.render_cache
+    if cache is not None:
+        # Cached bodies are stored encoded, so encodings must not mix: only
+        # ever ask for gzip or nothing, and key on which it was
+        gzip = 'gzip' in fetch_headers['Accept-Encoding']
+        fetch_headers['Accept-Encoding'] = 'gzip' if gzip else 'identity'
+        key = cache.key(args, gzip)
+        cached = cache.open(key)
+        if cached is not None:
+            headers, fd = cached
+            response = flask.Response(
+                response=stream_file(fd),
+                headers=headers,
+                direct_passthrough=True,
+            )
+            return response.make_conditional(request)
+    flight_key = request_key(args, sorted(fetch_headers.items()))
+    if request.method == 'GET':
+        flight, leader = render_flights.join(flight_key, Broadcast)
+    else:
+        # HEAD responses are never iterated, so have nothing to share
+        flight, leader = Broadcast(), True
+    if not leader:
+        head = flight.wait()
+        # Leader failed before even getting a response, or is too far along
+        # to replay from the start; go it alone
+        if head is not None:
+            status, headers = head
+            return flask.Response(
+                response=flight.follow(),
+                status=status,
+                headers=headers,
+                direct_passthrough=True,
+            )
+        flight = Broadcast()
+    try:
+        upstream = config.graphite.get(
+            "/render/",
+            params=args,
+            headers=fetch_headers,
+            stream=True,
+        )
+    except Exception:
+        flight.finish()
+        render_flights.leave(flight_key, flight)
+        raise
+    headers = downstream_headers(upstream.headers)
+    headers.append(('Vary', 'Accept-Encoding'))
+    flight.start((upstream.status_code, headers))
+    sink = None
+    if (cache is not None and upstream.status_code == 200
+        and request.method == 'GET'):
+        ttl = render_ttl(args, *config.render_ttl)
+        sink = cache.writer(key, cacheable_headers(headers), ttl)
+    chunks = stream(upstream, sink, flight)
+    started = []
+    def body():
+        started.append(True)
+        for chunk in chunks:
+            yield chunk
+    def release():
+        if started:
+            chunks.close()
+        else:
+            # Body never read (e.g. HEAD), so stream() never got to clean up
+            discard(upstream, sink, flight)
+        render_flights.leave(flight_key, flight)
+    # Werkzeug closes this whether or not the body gets iterated; a plain
+    # generator's ``finally`` only runs if it was started.
+    return flask.Response(
+        response=ClosingIterator(body(), release),
+        status=upstream.status_code,
+        headers=headers,
+        direct_passthrough=True,
+    )
@@ -0,0 +1,70 @@
+import itertools
+import threading
+import time
+
+
+class Backend(object):
+    """
+    One Graphite webapp, with passive health tracking.
+
+    Callers report each request's outcome via ``succeeded``/``failed``. After
+    ``threshold`` failures in a row the backend is considered down for
+    ``cooldown`` seconds, after which it's given another chance.
+    """
+    def __init__(self, uri, threshold=3, cooldown=30):
+        self.uri = uri
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.down_until = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Backend %r%s>" % (self.uri, "" if self.healthy else " (down)")
+
+    @property
+    def healthy(self):
+        return time.time() >= self.down_until
+
+    def succeeded(self):
+        with self._lock:
+            self.failures = 0
+            self.down_until = 0
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.down_until = time.time() + self.cooldown
+
+
+class Backends(object):
+    """
+    The set of Graphite webapps to use, taking turns at serving requests.
+
+    Backends are replicas of one another: any of them may be asked anything.
+    """
+    def __init__(self, uris, threshold=3, cooldown=30):
+        self.all = [Backend(x, threshold, cooldown) for x in uris]
+        self._turn = itertools.count()
+
+    def __iter__(self):
+        return iter(self.all)
+
+    def __len__(self):
+        return len(self.all)
+
+    def rotation(self):
+        """
+        Return every backend, in the order a request should try them.
+
+        Healthy backends come first, starting from whichever one's turn it is
+        (so load is spread round-robin); backends which are down come last,
+        as a last resort.
+        """
+        start = next(self._turn) % len(self.all)
+        ordered = self.all[start:] + self.all[:start]
+        return (
+            [x for x in ordered if x.healthy]
+            + [x for x in ordered if not x.healthy]
+        )
@@ -0,0 +1,375 @@
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from concurrency import SingleFlight
+
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class TTLCache(object):
+    """
+    Thread-safe, size-bounded mapping whose entries expire after ``ttl`` secs.
+
+    When more than ``size`` entries are stored, the least recently used ones
+    are evicted. ``hits`` and ``misses`` count lookups, for monitoring.
+    """
+    def __init__(self, size=1000, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires < time.time():
+                self.misses += 1
+                return default
+            # Re-insert to mark as most recently used
+            self._data[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """
+        Drop ``key`` from the cache, or everything if no key is given.
+        """
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+
+class PageCache(object):
+    """
+    Rendered pages, served stale while fresh copies are made in the background.
+
+    Each page is fresh for the ``ttl`` it was stored with. For ``stale``
+    seconds after that, the old copy is still returned straight away while a
+    single background thread renders a replacement; only requests for pages
+    which are missing or older than that wait for a render. At most ``size``
+    pages are kept, least recently used first out. Renders which call
+    ``uncacheable`` are returned but not stored.
+    """
+    def __init__(self, size=200, stale=600):
+        self.size = size
+        self.stale = stale
+        self.hits = 0
+        self.misses = 0
+        self.flights = SingleFlight()
+        self._data = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, ttl, render, regenerate=None):
+        """
+        Return the page for ``key``, calling ``render()`` to make it if needed.
+
+        ``regenerate`` is used instead of ``render`` for background renders,
+        e.g. to wrap it in a copy of the current request context.
+        """
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._data[key] = entry
+        if entry is not None:
+            expires, page = entry
+            now = time.time()
+            if now < expires + self.stale:
+                self.hits += 1
+                if now >= expires:
+                    self._regenerate(key, ttl, regenerate or render)
+                return page
+        self.misses += 1
+        return self.flights.do(key, self._render, key, ttl, render)
+
+    def set(self, key, page, ttl):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl, page)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def _render(self, key, ttl, render):
+        _local.uncacheable = False
+        try:
+            page = render()
+        finally:
+            keep = not _local.uncacheable
+            _local.uncacheable = False
+        if keep:
+            self.set(key, page, ttl)
+        return page
+
+    def _regenerate(self, key, ttl, render):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        def run():
+            try:
+                self.flights.do(key, self._render, key, ttl, render)
+            except Exception:
+                log.exception("Unable to regenerate page %r", key)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+
+def uncacheable():
+    """
+    Keep the page being rendered by this thread out of the ``PageCache``.
+
+    For pages missing some of their content, e.g. stats which timed out: any
+    earlier copy is served (or regenerated) as usual instead.
+    """
+    _local.uncacheable = True
+
+
+# Seconds per unit of Graphite's relative time syntax, keyed by the shortest
+# unambiguous prefix of each unit name (e.g. "-4hours", "-15min", "-1mon")
+UNITS = (
+    ('s', 1),
+    ('mi', 60),
+    ('h', 3600),
+    ('d', 86400),
+    ('w', 604800),
+    ('mo', 2592000),
+    ('y', 31536000),
+)
+
+def relative_seconds(value):
+    """
+    Parse a relative Graphite time like ``-4hours`` into seconds (e.g. 14400).
+
+    Returns ``None`` for anything else, such as absolute times or ``now``.
+    """
+    match = re.match(r'^-?(\d+)([a-z]+)$', str(value).strip())
+    if not match:
+        return None
+    number, unit = match.groups()
+    for prefix, seconds in UNITS:
+        if unit.startswith(prefix):
+            return int(number) * seconds
+    return None
+
+def render_ttl(params, minimum=60, maximum=86400):
+    """
+    How long may a render with the given params be cached for?
+
+    A graph can't visibly change until about one pixel's worth of time has
+    passed, so this is the graph's time window divided by its width: a
+    ``-7days`` graph keeps for much longer than a ``-4hours`` one. Graphs
+    ending at a fixed point in the past keep for ``maximum``; anything which
+    can't be worked out keeps for ``minimum``.
+    """
+    start = relative_seconds(params.get('from', '-1days'))
+    until = params.get('until', 'now')
+    end = 0 if until == 'now' else relative_seconds(until)
+    if start is None or end is None:
+        # Absolute start or end: only historical if the end is fixed
+        if until != 'now' and end is None:
+            return maximum
+        return minimum
+    try:
+        width = int(params.get('width', 330))
+    except ValueError:
+        width = 330
+    ttl = (start - end) / max(width, 1)
+    return min(max(ttl, minimum), maximum)
+
+
+def request_key(params, *extra):
+    """
+    Normalize multi-valued ``params`` (a MultiDict) into a hashed key.
+
+    Parameter names are sorted, but the order of repeated values (i.e.
+    targets, whose order affects drawing) is preserved. Any ``extra`` values
+    (e.g. response encoding) are included in the key as well.
+    """
+    normalized = sorted(
+        (name, [unicode(x) for x in values])
+        for name, values in params.lists()
+    )
+    return hashlib.sha1(repr((normalized, extra))).hexdigest()
+
+
+class DiskCache(object):
+    """
+    Size-bounded, expiring cache of HTTP responses stored under ``directory``.
+
+    Safe to share between processes: entries are written to a temporary file
+    and renamed into place, so readers never see partial writes. Each entry's
+    mtime doubles as its last-used time; when the directory grows past
+    ``max_bytes`` the least recently used entries are deleted.
+    """
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Estimated size on disk; only recounted when it looks like we're over
+        self._size = None
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, params, *extra):
+        return request_key(params, *extra)
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def open(self, key):
+        """
+        Return ``(headers, file)`` for ``key``, or ``None`` if absent/expired.
+
+        ``file`` is positioned at the start of the cached body; closing it is
+        up to the caller.
+        """
+        path = self.path(key)
+        try:
+            fd = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            meta = json.loads(fd.readline())
+            if meta['expires'] < time.time():
+                fd.close()
+                return None
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            fd.close()
+            return None
+        return meta['headers'], fd
+
+    def get(self, key):
+        """
+        Return ``(headers, body)`` for ``key``, or ``None`` if absent/expired.
+        """
+        entry = self.open(key)
+        if entry is None:
+            return None
+        headers, fd = entry
+        with fd:
+            return headers, fd.read()
+
+    def writer(self, key, headers, ttl):
+        """
+        Return a file-like object for writing ``key``'s body incrementally.
+
+        Nothing is visible to readers until its ``commit`` method is called;
+        call ``abort`` instead to throw the partial entry away.
+        """
+        return CacheWriter(self, key, headers, ttl)
+
+    def set(self, key, headers, body, ttl):
+        writer = self.writer(key, headers, ttl)
+        writer.write(body)
+        writer.commit()
+
+    def _added(self, size):
+        with self._lock:
+            if self._size is None:
+                self._size = self.evict()
+            else:
+                self._size += size
+                if self._size > self.max_bytes:
+                    self._size = self.evict()
+
+    def evict(self):
+        """
+        Delete least recently used entries until under budget; return new size.
+        """
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                # Leave other processes' in-progress writes alone
+                if name.startswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(x[1] for x in entries)
+        # Evict down to a little under budget so we don't do this every write
+        target = self.max_bytes * 0.9
+        if total > self.max_bytes:
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+        return total
+
+
+class CacheWriter(object):
+    """
+    In-progress DiskCache entry, written to a temporary file until committed.
+    """
+    def __init__(self, cache, key, headers, ttl):
+        self.cache = cache
+        self.path = cache.path(key)
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError: # another process got there first
+                pass
+        fd, self.tmp = tempfile.mkstemp(dir=directory, prefix='.tmp')
+        self.file = os.fdopen(fd, 'wb')
+        meta = json.dumps({'expires': time.time() + ttl, 'headers': headers})
+        self.size = 0
+        self.write(meta + "\n")
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        self.file.close()
+        os.rename(self.tmp, self.path)
+        self.cache._added(self.size)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.tmp)
+        except OSError:
+            pass
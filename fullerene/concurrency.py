@@ -0,0 +1,264 @@
+from multiprocessing.pool import ThreadPool
+import sys
+import threading
+import time
+
+import instrument
+
+
+# Bytes of a broadcast body kept around for followers who join late
+REPLAY_LIMIT = 1024 * 1024
+
+
+class Pool(object):
+    """
+    Lazily-started thread pool for fanning out blocking Graphite requests.
+
+    The underlying threads aren't spun up until the first call to ``gather``,
+    so merely loading a config never starts any threads.
+    """
+    def __init__(self, size=8):
+        self.size = size
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.size)
+            return self._pool
+
+    def gather(self, calls, deadline=None, default=None):
+        """
+        Run ``calls`` (an iterable of ``(func, args)``) in parallel.
+
+        Returns a list of results in the same order as ``calls``. Any call
+        which raised an exception, or had not finished by the time ``deadline``
+        seconds (total, not per call) have elapsed, results in ``default``
+        instead. Stragglers are left to finish in the background; their results
+        are simply discarded.
+
+        Calls are timed against the calling thread's request, if any.
+        """
+        pending = [self.submit(func, args) for func, args in calls]
+        end = None if deadline is None else time.time() + deadline
+        results = []
+        for result in pending:
+            timeout = None if end is None else max(end - time.time(), 0)
+            try:
+                results.append(result.get(timeout))
+            except Exception: # includes TimeoutError
+                results.append(default)
+        return results
+
+    def submit(self, func, args=()):
+        """
+        Start ``func(*args)`` in the background, returning its ``AsyncResult``.
+
+        As with ``gather``, the call is timed against the caller's request.
+        """
+        return self.pool.apply_async(instrument.bind(func), args)
+
+    def close(self):
+        """
+        Let any queued calls finish, then shut the threads down.
+        """
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent identical operations into a single one.
+
+    The first caller to ``join`` a given key becomes its leader; everybody
+    else joining the same key before the leader calls ``leave`` shares the
+    leader's flight object instead of doing the work themselves.
+    """
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key, factory):
+        """
+        Return ``(flight, leader)`` for ``key``.
+
+        ``flight`` is created via ``factory()`` if nobody else is in flight
+        for ``key``; ``leader`` is ``True`` if that happened.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = factory()
+            return flight, True
+
+    def leave(self, key, flight=None):
+        """
+        End the flight for ``key`` (only if it's ``flight``, when given.)
+        """
+        with self._lock:
+            if flight is None or self._flights.get(key) is flight:
+                self._flights.pop(key, None)
+
+    def do(self, key, func, *args):
+        """
+        Return ``func(*args)``, sharing the result with concurrent callers.
+
+        Exceptions are shared too: every caller waiting on a failed call gets
+        it re-raised.
+        """
+        call, leader = self.join(key, Call)
+        if leader:
+            try:
+                call.result = func(*args)
+            except Exception:
+                call.error = sys.exc_info()
+            finally:
+                self.leave(key)
+                call.event.set()
+        else:
+            call.event.wait()
+        if call.error is not None:
+            raise call.error[0], call.error[1], call.error[2]
+        return call.result
+
+
+class Call(object):
+    """
+    A single in-flight function call; see ``SingleFlight.do``.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Broadcast(object):
+    """
+    A single in-flight streamed response, replayed to any number of followers.
+
+    The leader calls ``start`` with the response's status/headers, then
+    ``append`` for each chunk of the body and finally ``finish``. Followers
+    call ``wait`` for the status/headers and then iterate over ``follow`` to
+    receive each chunk as it arrives.
+
+    Only the first ``limit`` bytes are kept for replaying to followers who
+    join late; past that, chunks are dropped as soon as every follower has
+    had them, and ``wait`` turns away anybody new.
+    """
+    def __init__(self, limit=REPLAY_LIMIT):
+        self.limit = limit
+        self.head = None
+        self.chunks = []
+        # Position in the body of chunks[0], and bytes held in self.chunks
+        self.offset = 0
+        self.size = 0
+        self.truncated = False
+        self.done = False
+        # Followers between ``wait`` and ``follow``, and those following
+        self.pending = 0
+        self.positions = {}
+        self._cond = threading.Condition()
+
+    @property
+    def followers(self):
+        return self.pending + len(self.positions)
+
+    def start(self, head):
+        with self._cond:
+            self.head = head
+            self._cond.notify_all()
+
+    def append(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+            if self.size > self.limit:
+                self.truncated = True
+            self._trim()
+            self._cond.notify_all()
+
+    def finish(self):
+        with self._cond:
+            self.done = True
+            self._cond.notify_all()
+
+    def wait(self):
+        """
+        Wait for and return the leader's status/headers.
+
+        Returns ``None`` if the leader failed before getting that far, or if
+        the start of the body is no longer available to replay.
+        """
+        with self._cond:
+            while self.head is None and not self.done:
+                self._cond.wait()
+            if self.head is None or self.truncated:
+                return None
+            self.pending += 1
+            return self.head
+
+    def follow(self):
+        """
+        Return an iterator over the body, for a follower which has ``wait``-ed.
+        """
+        with self._cond:
+            self.pending -= 1
+            follower = Follower(self)
+            self.positions[follower] = 0
+            return follower
+
+    def _next(self, follower):
+        with self._cond:
+            index = self.positions.get(follower)
+            if index is None:
+                raise StopIteration
+            while index >= self.offset + len(self.chunks) and not self.done:
+                self._cond.wait()
+            if index >= self.offset + len(self.chunks):
+                self._leave(follower)
+                raise StopIteration
+            chunk = self.chunks[index - self.offset]
+            self.positions[follower] = index + 1
+            self._trim()
+            return chunk
+
+    def _leave(self, follower):
+        with self._cond:
+            if self.positions.pop(follower, None) is not None:
+                self._trim()
+
+    def _trim(self):
+        # Keep everything while it's small enough to replay from the start
+        if not self.truncated or self.pending:
+            return
+        end = self.offset + len(self.chunks)
+        drop = min(self.positions.values() or [end]) - self.offset
+        if drop > 0:
+            self.size -= sum(len(x) for x in self.chunks[:drop])
+            del self.chunks[:drop]
+            self.offset += drop
+
+
+class Follower(object):
+    """
+    One follower's progress through a ``Broadcast``; see ``Broadcast.follow``.
+
+    Closing it (as WSGI servers do once the response is over) lets the
+    broadcast drop chunks this follower would otherwise still be owed.
+    """
+    def __init__(self, broadcast):
+        self.broadcast = broadcast
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.broadcast._next(self)
+
+    def close(self):
+        self.broadcast._leave(self)
@@ -1,35 +1,97 @@
+import copy
+import logging
+import os
+import signal
+import threading
+
 import yaml
 
+from cache import DiskCache, PageCache
 from graphite import Graphite
+from index import Refresher
 from metric import Metric
+from utils import freeze
+
+
+log = logging.getLogger(__name__)
 
 
 class Config(object):
-    def __init__(self, text):
+    """
+    Parsed, ready-to-use snapshot of a YAML config.
+
+    When replacing an existing snapshot (e.g. on reload), pass it as
+    ``previous``: if the Graphite settings haven't changed, its Graphite
+    object, along with that object's caches, indexes and connections, is
+    carried over rather than starting from cold.
+    """
+    def __init__(self, text, previous=None):
         # Load up
         config = yaml.load(text)
         # Required items
         try:
-            try:
-                exclude_hosts = config['hosts']['exclude']
-            except KeyError:
-                exclude_hosts = []
-            self.graphite = Graphite(
+            hosts = config.get('hosts', {})
+            exclude_hosts = hosts.get('exclude', [])
+            stats = config.get('stats', {})
+            http = config.get('http', {})
+            cache = config.get('cache', {})
+            index = config.get('index', {})
+            self.graphite_options = dict(
                 uri=config['graphite_uris']['internal'],
-                exclude_hosts=exclude_hosts
+                exclude_hosts=exclude_hosts,
+                stats_workers=stats.get('workers', 8),
+                stats_timeout=stats.get('timeout', 10),
+                stats_batch_size=stats.get('batch_size', 20),
+                pool_size=http.get('pool_size', 10),
+                connect_timeout=http.get('connect_timeout', 3.05),
+                read_timeout=http.get('read_timeout', 30),
+                retries=http.get('retries', 2),
+                backoff=http.get('backoff', 0.2),
+                failure_threshold=http.get('failure_threshold', 3),
+                failure_cooldown=http.get('failure_cooldown', 30),
+                expand_cache_size=cache.get('expand_size', 1000),
+                expand_cache_ttl=cache.get('expand_ttl', 300),
+                index_refresh=index.get('refresh', None),
+                hosts_refresh=hosts.get('refresh', 300),
             )
         except KeyError:
             raise ValueError, "Configuration must specify graphite_uris: internal"
+        if (previous is not None
+            and previous.graphite_options == self.graphite_options):
+            self.graphite = previous.graphite
+        else:
+            self.graphite = Graphite(**self.graphite_options)
+        # Optional on-disk cache for the /render/ proxy
+        self.render_cache = None
+        if 'render_dir' in cache:
+            directory = cache['render_dir']
+            max_bytes = cache.get('render_bytes', 256 * 1024 * 1024)
+            kept = previous and previous.render_cache
+            if (kept and kept.directory == directory
+                and kept.max_bytes == max_bytes):
+                self.render_cache = kept
+            else:
+                self.render_cache = DiskCache(directory, max_bytes)
+        self.render_ttl = (
+            cache.get('render_min_ttl', 60),
+            cache.get('render_max_ttl', 86400),
+        )
+        # Optional in-memory cache of rendered pages. Always starts out
+        # empty, since pages depend on the rest of the config.
+        self.page_cache = None
+        if cache.get('page_size'):
+            self.page_cache = PageCache(
+                size=cache['page_size'],
+                stale=cache.get('page_stale', 600),
+            )
         # Optional external URL (for links)
         self.external_graphite = config['graphite_uris'].get('external', None)
+        # Every distinct metric definition, shared by all references to it
+        self._interned = {}
         # 'metrics' section
         self.metrics = {}
         for name, options in config.get('metrics', {}).iteritems():
-            self.metrics[name] = Metric(
-                options=options,
-                config=self,
-                name=name
-            )
+            self.metrics[name] = self.intern_metric(options, name)
         # Metric groups
         self.groups = {}
         for name, metrics in config.get('metric_groups', {}).iteritems():
@@ -42,16 +104,25 @@ class Config(object):
         for collection in self.collections.values():
             # Instantiate metrics where needed
             for group in collection['groups'].values():
-                group['metrics'] = map(self.parse_metric, group['metrics'])
+                group['metrics'] = tuple(
+                    map(self.parse_metric, group['metrics'])
+                )
                 if 'overview' in group:
-                    group['overview'] = map(
-                        self.parse_metric,
-                        group['overview'][:]
+                    group['overview'] = tuple(
+                        map(self.parse_metric, group['overview'])
                     )
         # Default graph args
         self.defaults = config.get('defaults', {})
         # Timeperiod aliases
         self.periods = config.get('periods', {})
+        # Per-request profiling options
+        self.profiling = config.get('profile', {})
+        # Send host and group pages out as they render (see stream_page)
+        self.streaming = config.get('streaming', False)
+        # Leave stats tables for the browser to fill in (see /stats/)
+        self.defer_stats = config.get('defer_stats', False)
+        # How often to check the config file for changes (0 = never)
+        self.reload_interval = config.get('reload', {}).get('interval', 5)
 
     def parse_metric(self, item):
         exists = False
@@ -65,14 +136,105 @@ class Config(object):
         else:
             # String == metric path == make new metric from it
             if isinstance(item, basestring):
-                metric = Metric({'path': item}, config=self, name=item)
+                metric = self.intern_metric({'path': item}, item)
             # Non-string == assume hash/dict == make metric from that (assumes
             # one-item dict, name => metric)
             else:
                 name, value = item.items()[0]
-                metric = Metric(name=name, config=self, options=value)
+                metric = self.intern_metric(value, name)
         return metric
 
+    def intern_metric(self, options, name):
+        """
+        Return the Metric for this name and definition, creating it only once.
+
+        Identical definitions (e.g. the same path listed in several groups)
+        thus share one Metric, along with its parsed path and excludes.
+        """
+        key = (name, freeze(options))
+        try:
+            return self._interned[key]
+        except KeyError:
+            # Metric consumes its options, so don't hand it the YAML's own
+            metric = Metric(copy.deepcopy(options), config=self, name=name)
+            self._interned[key] = metric
+            return metric
+
     @property
     def metric_groups(self):
         return sorted(self.groups)
+
+
+class ConfigFile(Refresher):
+    """
+    A config file on disk, reloaded in the background whenever it changes.
+
+    ``config`` is always a complete Config: each reload parses the new file
+    into a fresh snapshot and swaps it in with a single assignment, so
+    requests never wait on parsing or see a half-loaded config. A file which
+    fails to load is logged and the previous snapshot kept.
+
+    Graphite objects replaced by a reload are shut down ``grace`` seconds
+    later, once requests still using them have had time to finish.
+    """
+    def __init__(self, path, grace=60):
+        self.path = path
+        self.grace = grace
+        self.config = None
+        self.signature = None
+        self._reload_lock = threading.Lock()
+        self.reload()
+        super(ConfigFile, self).__init__(self.config.reload_interval)
+
+    def __repr__(self):
+        return "<ConfigFile %r>" % self.path
+
+    def refresh(self):
+        """
+        Reload if the file has been modified since it was last loaded.
+        """
+        stat = os.stat(self.path)
+        if (stat.st_mtime, stat.st_size) != self.signature:
+            self.reload()
+
+    def reload(self):
+        with self._reload_lock:
+            stat = os.stat(self.path)
+            with open(self.path) as fd:
+                text = fd.read()
+            previous = self.config
+            self.config = Config(text, previous)
+            self.signature = (stat.st_mtime, stat.st_size)
+            if previous is None:
+                return
+            log.info("Reloaded %s", self.path)
+            self.interval = self.config.reload_interval or self.interval
+            if previous.graphite is not self.config.graphite:
+                timer = threading.Timer(self.grace, previous.graphite.close)
+                timer.daemon = True
+                timer.start()
+
+    def watch(self):
+        """
+        Start checking for changes every ``interval`` seconds, and reload
+        immediately on SIGHUP.
+        """
+        if self.interval:
+            self.start()
+        try:
+            signal.signal(signal.SIGHUP, self._hangup)
+        # No SIGHUP (Windows), or not the main thread
+        except (AttributeError, ValueError):
+            pass
+
+    def _hangup(self, signum, frame):
+        # Don't hold up whatever the signal interrupted
+        thread = threading.Thread(target=self._reload_logged)
+        thread.daemon = True
+        thread.start()
+
+    def _reload_logged(self):
+        try:
+            self.reload()
+        except Exception:
+            log.exception("Unable to reload %s", self.path)
@@ -35,9 +35,13 @@ class Graph(object):
         # Set kwargs for drawing
         self.kwargs = kwargs
 
-        # Store data about what our graph shows (e.g. min/max)
-        if config:
-            self.stats = config.graphite.stats(kwargs)
+        # Data about what our graph shows (e.g. min/max) is only fetched when
+        # something asks for it; see ``stats``.
+        self.config = config
+        self._stats = None
+        # Callable returning stats being fetched in the background, if any;
+        # see ``Graphite.prefetch_stats``.
+        self.pending = None
 
     def __str__(self):
         return self.path
@@ -47,6 +51,32 @@ class Graph(object):
             str(self), self.children, self.kwargs
         )
 
+    @property
+    def stats(self):
+        """
+        Stats (min/max etc) for this graph's target(s), fetched on first access.
+
+        Pages only showing thumbnails never touch this and thus never cost a
+        ``format=json`` render. Pages which do display stats should opt in to
+        prefetching them in bulk via ``Graphite.fetch_stats``, which sets this
+        attribute for a whole page's worth of graphs at once, or
+        ``Graphite.prefetch_stats``, after which this waits for the results.
+        """
+        if self._stats is None and self.pending is not None:
+            self._stats, self.pending = self.pending(), None
+        if self._stats is None:
+            self._stats = []
+            if self.config:
+                try:
+                    self._stats = self.config.graphite.stats(self.kwargs)
+                except Exception:
+                    pass
+        return self._stats
+
+    @stats.setter
+    def stats(self, value):
+        self._stats = value
+
     @property
     def querystring(self):
         """
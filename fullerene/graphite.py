@@ -1,8 +1,67 @@
-from collections import defaultdict
+from collections import defaultdict, deque
+import functools
+import itertools
 import json
+import sys
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from backends import Backends
+from cache import TTLCache
+from concurrency import Pool, SingleFlight
+from index import HostIndex, MetricIndex
+import instrument
+from series import parse_render
+from summary import summarize
+from utils import chunked, glob_to_regex
+
+
+# Render parameters which affect the data returned, as opposed to purely
+# presentational ones like height or title. Stats for targets sharing these
+# can be fetched together in a single multi-target render.
+WINDOW_PARAMS = ('from', 'until')
+
+# Upstream statuses worth retrying, and then trying another backend for
+FAILOVER_STATUSES = (500, 502, 503, 504)
 
-from utils import dots, sliced
+# Bytes per chunk when reading render bodies
+CHUNK_SIZE = 64 * 1024
+
+# Default number of /metrics/find/ requests a crawl makes at once
+CRAWL_CONCURRENCY = 8
+
+
+def stats_window(kwargs):
+    """
+    Return the render params (as sorted pairs) shaping ``kwargs``' stats data.
+
+    Besides the time window, this has Graphite consolidate each series down
+    to at most one datapoint per pixel of the graph's ``width``, so stats
+    match what's drawn and responses stay the same size however long the
+    period is.
+    """
+    window = [(key, kwargs[key]) for key in WINDOW_PARAMS if key in kwargs]
+    if 'width' in kwargs:
+        window.append(('maxDataPoints', kwargs['width']))
+    return tuple(window)
+
+
+def endpoint(path, params=None):
+    """
+    Name the kind of Graphite request being made, for instrumentation.
+    """
+    if path.startswith("/metrics/"):
+        return path.strip('/').split('/')[-1].split('.')[0]
+    if path.startswith("/render"):
+        if isinstance(params, list):
+            params = dict(params)
+        if params and params.get('format') == 'json':
+            return "stats"
+        return "render"
+    return path
 
 
 class Graphite(object):
@@ -11,9 +70,101 @@ class Graphite(object):
 
     Mostly used for querying API endpoints under /metrics/.
     """
-    def __init__(self, uri, exclude_hosts):
-        self.uri = uri
+    def __init__(self, uri, exclude_hosts, stats_workers=8, stats_timeout=10,
+        stats_batch_size=20, pool_size=10, connect_timeout=3.05,
+        read_timeout=30, retries=2, backoff=0.2, expand_cache_size=1000,
+        expand_cache_ttl=300, index_refresh=None, hosts_refresh=300,
+        failure_threshold=3, failure_cooldown=30):
+        # One or more interchangeable webapps; see get()
+        uris = [uri] if isinstance(uri, basestring) else list(uri)
+        self.backends = Backends(uris, failure_threshold, failure_cooldown)
+        self.uri = uris[0]
         self.exclude_hosts = exclude_hosts
+        # Host/domain listing for the index & domain pages
+        self.hosts = HostIndex(self, hosts_refresh)
+        # Memoized /metrics/expand/ results; see query()
+        self.expansions = TTLCache(expand_cache_size, expand_cache_ttl)
+        self.flights = SingleFlight()
+        # Optional local copy of the entire metric tree; see query()
+        self.index = None
+        if index_refresh:
+            self.index = MetricIndex(self, index_refresh)
+        # Shared keep-alive connection pool for all upstream requests
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=backoff,
+                status_forcelist=FAILOVER_STATUSES,
+                raise_on_status=False,
+            ),
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # Pool used for fetching per-graph stats in parallel
+        self.pool = Pool(stats_workers)
+        self.stats_timeout = stats_timeout
+        self.stats_batch_size = stats_batch_size
+
+    def get(self, path, **kwargs):
+        """
+        GET ``path`` (e.g. ``"/render/"``) from Graphite via the shared session.
+
+        Connect/read timeouts and retries (with backoff) are applied to every
+        request; any ``kwargs`` are passed through to ``requests``.
+
+        With multiple backends, requests take turns between the healthy ones.
+        Backends are treated as replicas, each able to answer any request
+        (lookups and renders alike) for the whole metric tree. A backend which
+        errors, or still returns a 5xx after retrying, is failed over from to
+        the next; if all of them fail, the last 5xx response is returned, or
+        else the last error raised.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        kept = error = None
+        for backend in self.backends.rotation():
+            try:
+                response = self._attempt(backend, path, kwargs)
+            except requests.RequestException:
+                error = sys.exc_info()
+                continue
+            if kept is not None:
+                kept.close()
+            if response.status_code not in FAILOVER_STATUSES:
+                return response
+            kept = response
+        if kept is not None:
+            return kept
+        raise error[0], error[1], error[2]
+
+    def _attempt(self, backend, path, kwargs):
+        """
+        GET ``path`` from ``backend``, timing it and noting how it went.
+        """
+        start = time.time()
+        try:
+            response = self.session.get(backend.uri + path, **kwargs)
+        except requests.RequestException:
+            backend.failed()
+            raise
+        if response.status_code in FAILOVER_STATUSES:
+            backend.failed()
+        else:
+            backend.succeeded()
+        # Streamed bodies haven't been read yet; go by what we were told
+        if kwargs.get('stream', False):
+            size = int(response.headers.get('Content-Length', 0))
+        else:
+            size = len(response.content)
+        instrument.record(
+            endpoint(path, kwargs.get('params')),
+            time.time() - start,
+            size
+        )
+        return response
 
     def query(self, *paths, **kwargs):
         """
@@ -22,51 +173,264 @@ class Graphite(object):
         Basically just a wrapper around Graphite's /metrics/expand/ endpoint.
 
         Specify ``leaves_only=True`` to filter out any non-leaf results.
+
+        When a local metric index is configured (see ``index``) and loaded,
+        queries are resolved against it without contacting Graphite at all.
+        Otherwise, results are cached (see ``expansions``) since the metric
+        tree rarely changes; use ``invalidate`` to force fresh lookups.
         """
-        query = "?" + "&".join(map(lambda x: "query=%s" % x, paths))
-        uri = self.uri + "/metrics/expand/%s" % query
-        if kwargs.get('leaves_only', False):
-            uri += "&leavesOnly=1"
-        response = requests.get(uri)
+        leaves_only = kwargs.get('leaves_only', False)
+        if self.index is not None:
+            self.index.start()
+            if self.index.ready:
+                results = set()
+                for path in paths:
+                    results.update(self.index.expand(path, leaves_only))
+                return sorted(
+                    x for x in results if x not in self.exclude_hosts
+                )
+        key = (paths, leaves_only)
+        filtered = self.expansions.get(key)
+        if filtered is None:
+            # Identical concurrent lookups share a single request
+            filtered = self.flights.do(key, self._expand, paths, leaves_only)
+        # Copy, so callers can't mutate what's in the cache
+        return list(filtered)
+
+    def _expand(self, paths, leaves_only):
+        params = [('query', x) for x in paths]
+        if leaves_only:
+            params.append(('leavesOnly', 1))
+        response = self.get("/metrics/expand/", params=params)
         struct = json.loads(response.content)['results']
         filtered = filter(
             lambda x: x not in self.exclude_hosts,
             struct
         )
+        self.expansions.set((paths, leaves_only), filtered)
         return filtered
 
+    def close(self):
+        """
+        Stop background refreshes and release threads and connections.
+
+        For retiring an instance no longer in use, e.g. after a config reload.
+        """
+        self.hosts.stop()
+        if self.index is not None:
+            self.index.stop()
+        self.pool.close()
+        self.session.close()
+
+    def invalidate(self, *paths, **kwargs):
+        """
+        Forget cached ``query`` results for the given arguments (or all of them)
+        """
+        if paths:
+            self.expansions.invalidate(
+                (paths, kwargs.get('leaves_only', False))
+            )
+        else:
+            self.expansions.invalidate()
+
     def stats(self, kwargs):
         kwargs = dict(kwargs) # lest we screw it up for rendering later
+        kwargs.update(stats_window(kwargs))
         kwargs['format'] = 'json'
-        uri = "%s/render/" % self.uri
-        return json.loads(requests.get(uri, params=kwargs).content)
+        return self._render_series(kwargs)
 
-    def query_all(base, max_depth=7):
+    def _render_series(self, params):
         """
-        Return *all* metrics starting with the given ``base`` pattern/string.
+        Render ``params`` as JSON, returning summarized Series.
 
-        Assumes maximum realistic depth of ``max_depth``, due to the method
-        required to get multiple levels of metric paths out of Graphite.
+        The body is parsed as it streams in, rather than read in whole.
+        """
+        response = self.get("/render/", params=params, stream=True)
+        try:
+            response.raise_for_status()
+            return summarize(
+                parse_render(response.iter_content(CHUNK_SIZE))
+            )
+        finally:
+            response.close()
+
+    def stats_batch(self, kwargs_list, default=list):
+        """
+        Return stats for each of ``kwargs_list``, using as few renders as possible.
+
+        Targets sharing a time window (see ``stats_window``) are requested
+        together, ``stats_batch_size`` at a time, as one multi-target
+        ``format=json`` render whose series are then matched back up to the
+        target(s) they came from. Targets wrapped in render functions can't be
+        reliably matched back up (function output is often renamed) and so get
+        a render to themselves.
+
+        Renders run in parallel and share a single deadline of
+        ``stats_timeout`` seconds; any target whose render hasn't come back by
+        then (or which errored) gets ``default()`` instead: an empty stats
+        list, unless told otherwise.
+        """
+        calls = self._stats_calls(kwargs_list)
+        results = self.pool.gather(
+            [(self._stats_chunk, args) for _, args in calls],
+            deadline=self.stats_timeout,
+        )
+        stats = [default() for _ in kwargs_list]
+        for (chunk, _), result in zip(calls, results):
+            if result is not None:
+                for index, series in zip(chunk, result):
+                    stats[index] = series
+        return stats
+
+    def _stats_calls(self, kwargs_list):
+        """
+        Plan the renders needed to get stats for ``kwargs_list``.
+
+        Returns ``(indices, (targets, window))`` pairs: the positions in
+        ``kwargs_list`` covered by each render, and the arguments for
+        ``_stats_chunk`` to perform it.
+        """
+        windows = defaultdict(list)
+        chunks = []
+        for index, kwargs in enumerate(kwargs_list):
+            window = stats_window(kwargs)
+            if '(' in kwargs['target']:
+                chunks.append(([index], window))
+            else:
+                windows[window].append(index)
+        for window, indices in windows.items():
+            for chunk in chunked(indices, self.stats_batch_size):
+                chunks.append((chunk, window))
+        return [
+            (chunk, ([kwargs_list[x]['target'] for x in chunk], window))
+            for chunk, window in chunks
+        ]
+
+    def _stats_chunk(self, targets, window):
+        """
+        Render ``targets`` as JSON in one request, returning per-target series.
+        """
+        params = [('target', x) for x in targets] + list(window)
+        params.append(('format', 'json'))
+        series = self._render_series(params)
+        # A lone target owns everything in the response, regardless of naming
+        if len(targets) == 1:
+            return [series]
+        matchers = map(glob_to_regex, targets)
+        results = [[] for _ in targets]
+        for item in series:
+            for matcher, result in zip(matchers, results):
+                if matcher.match(item.target):
+                    result.append(item)
+        return results
+
+    def fetch_stats(self, graphs):
+        """
+        Fill in ``stats`` on each of the given Graph objects, in bulk.
+
+        See ``stats_batch`` for how requests are batched and timed out. Graphs
+        whose stats were already fetched are skipped. Returns ``False`` if any
+        graph's stats failed or timed out (and so were left empty.)
+        """
+        graphs = [x for x in graphs if x._stats is None]
+        results = self.stats_batch([graph.kwargs for graph in graphs],
+            default=lambda: None)
+        for graph, stats in zip(graphs, results):
+            graph.stats = [] if stats is None else stats
+        return None not in results
+
+    def prefetch_stats(self, graphs):
+        """
+        Start fetching stats for the given Graph objects in the background.
 
-        If run with ``base="*"`` be prepared to wait a very long time for any
-        nontrivial Graphite installation to come back with the answer...
+        Batched like ``fetch_stats``, but returns straight away; each graph's
+        ``stats`` then waits for just the render its own target is part of
+        (up to ``stats_timeout`` seconds from now.)
         """
-        queries = []
-        for num in range(1, max_depth + 1):
-            query = "%s.%s" % (base, ".".join(['*'] * num))
-            queries.append(query)
-        return self.query(queries, leaves_only=True)
+        graphs = [x for x in graphs if x._stats is None and x.pending is None]
+        deadline = time.time() + self.stats_timeout
+        for chunk, args in self._stats_calls([x.kwargs for x in graphs]):
+            result = self.pool.submit(self._stats_chunk, args)
+            for position, index in enumerate(chunk):
+                graphs[index].pending = functools.partial(
+                    self._await_stats, result, position, deadline
+                )
+
+    def _await_stats(self, result, position, deadline):
+        try:
+            return result.get(max(deadline - time.time(), 0))[position]
+        except Exception: # includes TimeoutError
+            return []
+
+    def find(self, query):
+        """
+        Return the nodes matching ``query``, via Graphite's /metrics/find/.
+
+        Nodes are ``(path, leaf, branch)`` tuples, where ``leaf`` is whether
+        ``path`` is a metric and ``branch`` whether it has children; a node
+        may be both.
+        """
+        response = self.get("/metrics/find/", params={'query': query})
+        return [
+            (
+                node['id'],
+                bool(node.get('leaf')),
+                bool(node.get('expandable', node.get('allowChildren'))),
+            )
+            for node in json.loads(response.content)
+        ]
+
+    def crawl(self, prefix="*", max_depth=None, concurrency=None):
+        """
+        Yield every metric path matching or under ``prefix``, as found.
+
+        Walks the tree breadth first, one /metrics/find/ request per branch
+        node, so each part of the tree is only listed once; leaves are never
+        queried. Up to ``concurrency`` requests run at once, on the crawl's
+        own threads (so page stats fetches never queue up behind it.)
+        ``max_depth`` limits how many levels below ``prefix`` are descended
+        into. E.g. ``crawl("web1_example_com")`` lists one host's metrics;
+        ``crawl()`` lists the entire install.
+        """
+        pool = Pool(concurrency or CRAWL_CONCURRENCY)
+        queries = [prefix]
+        depth = 0
+        try:
+            while queries:
+                branches = []
+                for nodes in self._find_all(pool, queries):
+                    for path, leaf, branch in nodes:
+                        if path in self.exclude_hosts:
+                            continue
+                        if leaf:
+                            yield path
+                        if branch:
+                            branches.append(path + ".*")
+                depth += 1
+                if max_depth is not None and depth > max_depth:
+                    break
+                queries = branches
+        finally:
+            pool.close()
+
+    def _find_all(self, pool, queries):
+        """
+        Yield ``find`` results for ``queries`` in order, using all of ``pool``.
+        """
+        queries = iter(queries)
+        pending = deque(
+            pool.submit(self.find, (query,))
+            for query in itertools.islice(queries, pool.size)
+        )
+        while pending:
+            result = pending.popleft()
+            # Keep the window full while waiting on the oldest request
+            for query in itertools.islice(queries, 1):
+                pending.append(pool.submit(self.find, (query,)))
+            yield result.get()
 
     def hosts_by_domain(self):
-        hosts = self.query("*")
-        domains = defaultdict(list)
-        for host in hosts:
-            name, _, domain = host.partition('_')
-            domains[dots(domain)].append(dots(host))
-        return domains
+        return self.hosts.by_domain()
 
     def hosts_for_domain(self, domain):
-        return map(
-            lambda x: sliced(x, 1),
-            self.hosts_by_domain()[dots(domain)]
-        )
+        return self.hosts.for_domain(domain)
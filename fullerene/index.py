@@ -0,0 +1,201 @@
+from collections import defaultdict
+import json
+import logging
+import threading
+import time
+
+from utils import dots, glob_to_regex, is_pattern, sliced
+
+
+log = logging.getLogger(__name__)
+
+# Key marking a branch node which is also a leaf metric in its own right.
+# (Pure leaves are stored as None instead of a dict, to save memory.)
+LEAF = None
+
+
+def segment(part):
+    """
+    Intern path segment ``part``, shared by many paths, to save memory.
+
+    Segments from JSON are unicode; non-ASCII ones can't be interned and are
+    kept as they are (they still compare and hash equal to ASCII lookups.)
+    """
+    try:
+        return intern(str(part))
+    except UnicodeEncodeError:
+        return part
+
+
+class Refresher(object):
+    """
+    Base class for data periodically rebuilt from Graphite in the background.
+
+    Subclasses implement ``refresh``, which should build new data and then
+    swap it in with a single assignment, so readers only ever see a complete
+    old or new copy. The refresh thread is started on the first call to
+    ``start``; errors are logged and the previous data kept until the next
+    attempt. ``stop`` ends the thread after its current nap.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.refreshed = 0
+        self.stopped = False
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        raise NotImplementedError
+
+    def update(self):
+        """
+        Run ``refresh`` and note when it last happened.
+        """
+        self.refresh()
+        self.refreshed = time.time()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self):
+        self.stopped = True
+
+    def _run(self):
+        while not self.stopped:
+            # Data may have been refreshed by somebody else in the meantime
+            time.sleep(max(self.refreshed + self.interval - time.time(), 0))
+            if self.stopped:
+                break
+            try:
+                self.update()
+            except Exception:
+                log.exception("Unable to refresh %r", self)
+                time.sleep(self.interval)
+
+
+class MetricIndex(Refresher):
+    """
+    In-memory trie of every metric path known to Graphite.
+
+    Resolves the same patterns as Graphite's /metrics/expand/ (``*``, ``?``,
+    ``[...]``, ``{a,b}``) locally, walking only the branches which match.
+    Loaded from Graphite's /metrics/index.json every ``interval`` seconds.
+    """
+    def __init__(self, graphite, interval=600, paths=None):
+        super(MetricIndex, self).__init__(interval)
+        self.graphite = graphite
+        self.root = None
+        self._regexes = {}
+        if paths is not None:
+            self.root = self.build(paths)
+
+    def __repr__(self):
+        return "<MetricIndex for %r>" % self.graphite.uri
+
+    @property
+    def ready(self):
+        return self.root is not None
+
+    def refresh(self):
+        response = self.graphite.get("/metrics/index.json")
+        self.root = self.build(json.loads(response.content))
+
+    def build(self, paths):
+        """
+        Return a new trie containing ``paths``.
+
+        Branches are dicts of segment => child; leaves are ``None``.
+        """
+        root = {}
+        for path in paths:
+            node = root
+            parts = path.split('.')
+            for part in parts[:-1]:
+                part = segment(part)
+                child = node.get(part)
+                if child is None:
+                    child = node[part] = {} if part not in node else {LEAF: 1}
+                node = child
+            last = segment(parts[-1])
+            if last in node:
+                if node[last] is not None:
+                    node[last][LEAF] = 1
+            else:
+                node[last] = None
+        return root
+
+    def expand(self, pattern, leaves_only=False):
+        """
+        Return sorted list of paths matching ``pattern``.
+        """
+        nodes = [("", self.root)]
+        for part in pattern.split('.'):
+            matches = []
+            for prefix, node in nodes:
+                if not node:
+                    continue
+                for name in self._match(part, node):
+                    matches.append((prefix + name, node[name]))
+            nodes = [(prefix + '.', node) for prefix, node in matches]
+        results = [
+            prefix[:-1] for prefix, node in nodes
+            if not leaves_only or node is None or LEAF in node
+        ]
+        return sorted(results)
+
+    def _match(self, part, node):
+        if not is_pattern(part):
+            return [part] if part in node else []
+        regex = self._regexes.get(part)
+        if regex is None:
+            regex = self._regexes[part] = glob_to_regex(part)
+        return [x for x in node if x is not LEAF and regex.match(x)]
+
+
+class HostIndex(Refresher):
+    """
+    Hosts known to Graphite, grouped by domain.
+
+    Built synchronously on first use, then rebuilt every ``interval`` seconds
+    in the background; requests arriving mid-rebuild get the previous copy.
+    """
+    def __init__(self, graphite, interval=300):
+        super(HostIndex, self).__init__(interval)
+        self.graphite = graphite
+        # (domain => hosts, domain => short hostnames), swapped in together
+        self._data = None
+
+    def __repr__(self):
+        return "<HostIndex for %r>" % self.graphite.uri
+
+    def refresh(self):
+        # Always go to Graphite/the metric index, not the expansion cache
+        self.graphite.invalidate("*")
+        domains = defaultdict(list)
+        for host in self.graphite.query("*"):
+            name, _, domain = host.partition('_')
+            domains[dots(domain)].append(dots(host))
+        short = dict(
+            (domain, [sliced(x, 1) for x in hosts])
+            for domain, hosts in domains.iteritems()
+        )
+        self._data = (dict(domains), short)
+
+    @property
+    def data(self):
+        if self._data is None:
+            with self._lock:
+                if self._data is None:
+                    self.update()
+        self.start()
+        return self._data
+
+    def by_domain(self):
+        return self.data[0]
+
+    def for_domain(self, domain):
+        return self.data[1].get(dots(domain), [])
@@ -0,0 +1,171 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import threading
+import time
+
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_local = threading.local()
+
+
+class Timings(object):
+    """
+    Per-request tally of time (and bytes) spent, by name (e.g. "expand".)
+    """
+    def __init__(self, route=None):
+        self.route = route
+        self.start = time.time()
+        self.entries = defaultdict(lambda: [0, 0.0, 0])
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, size=0):
+        with self._lock:
+            entry = self.entries[name]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] += size
+
+    def server_timing(self):
+        """
+        Render as a ``Server-Timing`` header value.
+
+        Durations are summed per name, so requests made in parallel may add up
+        to more than the request's own ``total``.
+        """
+        parts = []
+        for name, (count, seconds, size) in sorted(self.entries.items()):
+            desc = "%d call%s" % (count, "" if count == 1 else "s")
+            if size:
+                desc += ", %d bytes" % size
+            parts.append('%s;dur=%.1f;desc="%s"' % (name, seconds * 1000, desc))
+        parts.append('total;dur=%.1f' % ((time.time() - self.start) * 1000))
+        return ", ".join(parts)
+
+
+def current():
+    """
+    Return the active Timings for this thread, if any.
+    """
+    return getattr(_local, 'timings', None)
+
+def activate(timings):
+    _local.timings = timings
+
+def bind(func):
+    """
+    Wrap ``func`` so it records into the caller's Timings from any thread.
+    """
+    timings = current()
+    def bound(*args, **kwargs):
+        previous = current()
+        activate(timings)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            activate(previous)
+    return bound
+
+def record(name, seconds, size=0):
+    """
+    Record an operation against the current request and process-wide stats.
+    """
+    timings = current()
+    route = None
+    if timings is not None:
+        timings.add(name, seconds, size)
+        route = timings.route
+    registry.observe(route, name, seconds, size)
+
+@contextmanager
+def timed(name):
+    """
+    Time the enclosed block as ``name`` against the current request only.
+
+    For breaking a request down into phases (e.g. template rendering); see
+    ``record`` for upstream calls, which are tracked process-wide as well.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings = current()
+        if timings is not None:
+            timings.add(name, time.time() - start)
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0.0
+        self.count = 0
+        self.size = 0
+
+    def observe(self, seconds, size=0):
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[index] += 1
+        self.total += seconds
+        self.count += 1
+        self.size += size
+
+
+class Registry(object):
+    """
+    Process-wide histograms of request and upstream call durations.
+    """
+    def __init__(self):
+        self.upstream = defaultdict(Histogram)
+        self.requests = defaultdict(Histogram)
+        self._lock = threading.Lock()
+
+    def observe(self, route, name, seconds, size=0):
+        with self._lock:
+            self.upstream[(route or "", name)].observe(seconds, size)
+
+    def observe_request(self, route, seconds):
+        with self._lock:
+            self.requests[route or ""].observe(seconds)
+
+    def prometheus(self):
+        """
+        Render all metrics in Prometheus' text exposition format.
+        """
+        lines = []
+        with self._lock:
+            upstream = sorted(
+                ('route="%s",endpoint="%s"' % key, histogram)
+                for key, histogram in self.upstream.items()
+            )
+            requests = sorted(
+                ('route="%s"' % route, histogram)
+                for route, histogram in self.requests.items()
+            )
+            self._histogram(lines, "fullerene_upstream_seconds",
+                "Time spent waiting on Graphite, by route and endpoint.",
+                upstream)
+            lines.append("# HELP fullerene_upstream_bytes_total Bytes "
+                "received from Graphite, by route and endpoint.")
+            lines.append("# TYPE fullerene_upstream_bytes_total counter")
+            for labels, histogram in upstream:
+                lines.append("fullerene_upstream_bytes_total{%s} %d" % (
+                    labels, histogram.size))
+            self._histogram(lines, "fullerene_request_seconds",
+                "Time spent handling requests, by route.", requests)
+        return "\n".join(lines) + "\n"
+
+    def _histogram(self, lines, name, help, series):
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s histogram" % name)
+        for labels, histogram in series:
+            for bound, count in zip(BUCKETS, histogram.counts):
+                lines.append('%s_bucket{%s,le="%s"} %d' % (
+                    name, labels, bound, count))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (
+                name, labels, histogram.count))
+            lines.append("%s_sum{%s} %f" % (name, labels, histogram.total))
+            lines.append("%s_count{%s} %d" % (name, labels, histogram.count))
+
+
+registry = Registry()
@@ -1,7 +1,15 @@
 from collections import defaultdict
+import re
 from types import StringTypes
 
 from graph import Graph
+import instrument
+from utils import chunked, glob_to_pattern, is_pattern
+
+
+# Hosts per request when expanding a metric for many hosts at once; keeps
+# request URLs well short of common server limits (~8KB.)
+HOSTS_PER_QUERY = 50
 
 
 def combine(paths, expansions=[], include_raw=False):
@@ -21,7 +29,7 @@ def combine(paths, expansions=[], include_raw=False):
     of [1]. Pretty tautological.
 
     A more complex example would be partial expansion. Calling
-    combine(["a.1.b.1", "a.1.b.2", "a.2.b.1", "a.2.b.2"], expansions=[1],
+    combine(["a.1.b.1", "a.1.b.2", "a.2.b.1", "a.2.b.2"], expansions=[3],
     include_raw=True) would result in:
 
         {
@@ -29,78 +37,56 @@ def combine(paths, expansions=[], include_raw=False):
             "a.{1,2}.b.2": ["a.1.b.2", "a.2.b.2"]
         }
 
-    because the first "overlapping" segment (a.1 vs a.2) is expanded, but the
-    second (b.1 vs b.2) is not, and thus we get two keys whose values split the
+    because the second "overlapping" segment (b.1 vs b.2) is expanded, but the
+    first (a.1 vs a.2) is not, and thus we get two keys whose values split the
     incoming 4-item list in half.
+
+    Runs in time linear in the number of paths: each path is placed directly
+    into its key's group, and keys are only ever generated for combinations
+    of expanded values which actually occur in ``paths``.
     """
-    # Preserve input
-    original_paths = paths[:]
+    # Split once up front; everything else works off the split paths
+    split = [path.split('.') for path in paths]
+    # Every value seen at each position, in order of first appearance
     buckets = defaultdict(list)
-    # Divvy up paths into per-segment buckets
-    for path in paths:
-        for i, part in enumerate(path.split('.')):
-            if part not in buckets[i]:
+    seen = defaultdict(set)
+    for parts in split:
+        for i, part in enumerate(parts):
+            if part not in seen[i]:
+                seen[i].add(part)
                 buckets[i].append(part)
-    # "Zip" up buckets as needed depending on expansions
-    ret = [[]]
-    for key in sorted(buckets.keys()):
-        value = list(buckets[key])
-        # Only one value for this index: everybody gets a copy
-        if len(value) == 1:
-            for x in ret:
-                x.append(value[0])
+    # Positions whose value is the same for every path in a given key: those
+    # with only one value overall, plus any being expanded. Every other
+    # position becomes a brace-expression of all its values.
+    expansions = set(expansions)
+    template = []
+    for i in range(len(buckets)):
+        values = buckets[i]
+        if len(values) == 1 or i in expansions:
+            template.append(None)
         else:
-            # If this index is to be expanded, branch out: all existing results
-            # up to this point get cloned, one per matching item
-            if key in expansions:
-                previous = ret[:]
-                ret = []
-                for x in value:
-                    for y in previous:
-                        ret.append(y + [x])
-            # No expansion = just drop in the iterable, no conversion to string
-            else:
-                for x in ret:
-                    x.append(value)
-    # Now that we're done, merge the chains into strings
+            template.append("{" + ",".join(values) + "}")
+    # Group paths by their values at expanded positions, in a single pass, so
+    # only combinations which actually occur in the input are ever output.
+    varying = [i for i in expansions if len(buckets.get(i, ())) > 1]
+    groups = {}
+    for path, parts in zip(paths, split):
+        group = tuple(parts[i] if i < len(parts) else None for i in varying)
+        if group not in groups:
+            groups[group] = (parts, [], set())
+        _, members, added = groups[group]
+        if path not in added:
+            added.add(path)
+            members.append(path)
+    # Then build each group's key just once
     mapping = {}
-    # TODO: This is so dumb. Must be a way to merge with the nearly-identical
-    # shit above.  I suck at algorithms.
-    for expr in ret:
-        key_parts = []
-        paths = [[]]
-        for part in expr:
-            if isinstance(part, list):
-                # Update paths
-                previous = paths[:]
-                paths = []
-                for subpart in part:
-                    for x in previous:
-                        paths.append(x + [subpart])
-                # Update key parts
-                part = "{" + ",".join(part) + "}"
-            else:
-                for path in paths:
-                    path.append(part)
-            key_parts.append(part)
-        # New final key/value pair
-        # (Strip out any incorrectly expanded paths not present in the input.)
-        # (TODO: figure out how not to expand combinatorically when that's not
-        # correct. sigh)
-        raw_paths = filter(
-            lambda x: x in original_paths,
-            map(lambda x: ".".join(x), paths)
+    for parts, members, _ in groups.itervalues():
+        key = ".".join(
+            part if part is not None else parts[i]
+            for i, part in enumerate(template)
+            if part is not None or i < len(parts)
         )
-        # Do the same for keys, when expanding; have to search substrings.
-        merged_path = ".".join(key_parts)
-        merged_path_good = False
-        lcd, _, rest = merged_path.partition('{')
-        for original in original_paths:
-            if original.startswith(lcd):
-                merged_path_good = True
-                break
-        if merged_path_good:
-            mapping[merged_path] = raw_paths
+        mapping[key] = members
     return mapping if include_raw else mapping.keys()
 
 
@@ -123,6 +109,7 @@ class Metric(object):
         self.wildcards = self.find_wildcards()
         # Normalize/clean up options
         self.excludes = self.set_excludes(options.pop('exclude', ()))
+        self.exclusions = self.compile_excludes()
         self.to_expand = self.set_expansions(options.pop('expand', ()))
         # Everything else given in the YAML config is a graphite override
         self.extra_options = options
@@ -139,6 +126,9 @@ class Metric(object):
             and self.to_expand == other.to_expand
         )
 
+    def __hash__(self):
+        return hash(self.path)
+
     def find_wildcards(self):
         """
         Fill in self.wildcards from self.parts
@@ -159,6 +149,42 @@ class Metric(object):
             excludes[key] = map(str, excludes[key])
         return excludes
 
+    def compile_excludes(self):
+        """
+        Compile self.excludes into one regex matching any excluded path.
+
+        Each wildcard slot's excludes become an alternation anchored to that
+        slot's position in the path, so a single ``match`` call tells whether
+        any slot of a path holds an excluded value. Exclude values may be
+        Graphite-style globs (e.g. ``loop*``) as well as literal strings.
+
+        Returns ``None`` if there's nothing to exclude.
+        """
+        rules = []
+        for index, values in sorted(self.excludes.items()):
+            # Excludes for wildcard slots we don't have can never match
+            if not values or not 0 <= index < len(self.wildcards):
+                continue
+            alternatives = "|".join(
+                glob_to_pattern(x) if is_pattern(x) else re.escape(x)
+                for x in values
+            )
+            rules.append(r"(?:[^.]*\.){%d}(?:%s)(?:\.|\Z)" % (
+                self.wildcards[index], alternatives
+            ))
+        if not rules:
+            return None
+        return re.compile("|".join("(?:%s)" % x for x in rules))
+
+    def exclude(self, paths):
+        """
+        Return those of ``paths`` not matching any of our excludes.
+        """
+        if self.exclusions is None:
+            return list(paths)
+        match = self.exclusions.match
+        return [x for x in paths if not match(x)]
+
     def set_expansions(self, expansions):
         if expansions == "all":
             expansions = self.wildcards 
@@ -179,6 +205,10 @@ class Metric(object):
         returned metric paths will still be host-agnostic (in order to blend in
         with non-expanded metric paths.)
         """
+        with instrument.timed('metric_expand'):
+            return self._expand(hostname)
+
+    def _expand(self, hostname):
         sep = '.'
         if hostname:
             path = sep.join([hostname, self.path])
@@ -188,6 +218,29 @@ class Metric(object):
             func = lambda x: x
         return map(func, self.config.graphite.query(path))
 
+    def expand_hosts(self, hostnames):
+        """
+        Return a dict mapping each of ``hostnames`` to its ``expand`` result.
+
+        Hosts are looked up ``HOSTS_PER_QUERY`` at a time, one request per
+        brace-expression (``{host1,host2}.path``), with results split back out
+        by their leading host segment.
+        """
+        with instrument.timed('metric_expand'):
+            return self._expand_hosts(hostnames)
+
+    def _expand_hosts(self, hostnames):
+        sep = '.'
+        results = dict((x, []) for x in hostnames)
+        for chunk in chunked(sorted(results), HOSTS_PER_QUERY):
+            prefix = chunk[0] if len(chunk) == 1 else "{%s}" % ",".join(chunk)
+            query = sep.join([prefix, self.path])
+            for path in self.config.graphite.query(query):
+                host, _, rest = path.partition(sep)
+                if host in results:
+                    results[host].append(rest)
+        return results
+
     def graphs(self, hostname="", **kwargs):
         """
         Return 1+ Graph objects, optionally using ``hostname`` for context.
@@ -204,6 +257,10 @@ class Metric(object):
         The kwargs will be used to override any defaults from the config
         object.
         """
+        with instrument.timed('metric_graphs'):
+            return self._paths_to_graphs(hostname, kwargs)
+
+    def _paths_to_graphs(self, hostname, kwargs):
         hostname = hostname.replace('.', '_')
         # If %-expressions in path, or raw=True, just insert hostname and skip
         # parsing
@@ -219,35 +276,55 @@ class Metric(object):
             else:
                 results = [self.path]
             return self._graphs(results, kwargs)
-        # Expand out to full potential list of paths, apply filters
-        matches = []
-        expanded = self.expand(hostname)
-        for item in expanded:
-            parts = item.split('.')
-            good = True
-            # Exclude any exclusions
-            for location, part in enumerate(parts):
-                # We only care about wildcard slots
-                if location not in self.wildcards:
-                    continue
-                # Which wildcard slot is this?
-                wildcard_index = self.wildcards.index(location)
-                # Is this substring listed for exclusion in this slot?
-                if part in self.excludes.get(wildcard_index, []):
-                    good = False
-                    break # move on to next metric/item
-            if good:
-                matches.append(item)
-        # Perform any necessary combining into brace-expressions & return
+        # Expand out to full potential list of paths, filter & combine
+        return self._graphs(self._select(hostname, self.expand(hostname)),
+            kwargs)
+
+    def graphs_for_hosts(self, hostnames, **kwargs):
+        """
+        Return a dict mapping each of ``hostnames`` to its ``graphs`` result.
+
+        Equivalent to calling ``graphs(hostname, **kwargs)`` per host, but
+        with one expansion request for the lot (see ``expand_hosts``) instead
+        of one per host.
+        """
+        with instrument.timed('metric_graphs'):
+            return self._hosts_to_graphs(hostnames, kwargs)
+
+    def _hosts_to_graphs(self, hostnames, kwargs):
+        if self.raw or "%s" in self.path or "%g" in self.path:
+            # Nothing to expand
+            return dict(
+                (x, self._paths_to_graphs(x, dict(kwargs)))
+                for x in hostnames
+            )
+        kwargs = dict(kwargs)
+        kwargs.pop('group', None)
+        names = dict((x, x.replace('.', '_')) for x in hostnames)
+        expansions = self.expand_hosts(names.values())
+        return dict(
+            (x, self._graphs(self._select(name, expansions[name]), kwargs))
+            for x, name in names.items()
+        )
+
+    def _select(self, hostname, paths):
+        """
+        Apply excludes & combining to expanded ``paths`` for ``hostname``.
+        """
+        matches = self.exclude(paths)
+        # Perform any necessary combining into brace-expressions
         result = combine(matches, self.to_expand)
-        result = map(lambda x: "%s.%s" % (hostname, x), result)
-        return self._graphs(result, kwargs)
+        if hostname:
+            result = map(lambda x: "%s.%s" % (hostname, x), result)
+        return result
 
     def _graphs(self, paths, kwargs):
         # Precedence: defaults => overridden by extra_options => kwargs
         first_merge = dict(self.extra_options, **kwargs)
         merged_kwargs = dict(self.config.defaults, **first_merge)
-        return [
-            Graph(path, self.config, self.title, self.title_param, **merged_kwargs)
-            for path in paths
-        ]
+        with instrument.timed('graph_init'):
+            return [
+                Graph(path, self.config, self.title, self.title_param,
+                    **merged_kwargs)
+                for path in paths
+            ]
@@ -0,0 +1,47 @@
+import cProfile
+import os
+import pstats
+import StringIO
+import time
+
+
+class Profile(object):
+    """
+    cProfile run covering a single request, plus its phase timings.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+
+    def report(self, timings=None, limit=40):
+        """
+        Return a plain text report: phase timings, then the top ``limit``
+        functions by cumulative time.
+        """
+        out = StringIO.StringIO()
+        out.write("Profile of %s\n\n" % self.name)
+        if timings is not None:
+            out.write("%-16s %8s %10s\n" % ("phase", "calls", "ms"))
+            for name, (count, seconds, _) in sorted(timings.entries.items()):
+                out.write("%-16s %8d %10.1f\n" % (name, count, seconds * 1000))
+            out.write("\n")
+        stats = pstats.Stats(self.profiler, stream=out)
+        stats.sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+    def dump(self, directory):
+        """
+        Save raw profile data under ``directory``, returning the file path.
+
+        The file can be loaded with ``pstats`` or tools like snakeviz.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, "%s-%d.prof" % (
+            self.name, int(time.time() * 1000)))
+        self.profiler.dump_stats(path)
+        return path
@@ -0,0 +1,102 @@
+# Headers which only apply to a single connection and must not be forwarded.
+HOP_BY_HOP = frozenset([
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'trailers', 'transfer-encoding', 'upgrade',
+])
+
+# Client request headers worth passing upstream
+FORWARDED = ('If-Modified-Since', 'If-None-Match', 'Accept-Encoding')
+
+# Upstream response headers never worth storing in a cache
+UNCACHEABLE = frozenset(['date', 'set-cookie'])
+
+CHUNK_SIZE = 64 * 1024
+
+
+def upstream_headers(headers):
+    """
+    Select headers from our client's request to send on to Graphite.
+
+    Without an explicit ``Accept-Encoding`` we ask for an unencoded response,
+    since the body is passed through to the client as-is.
+    """
+    forwarded = dict((x, headers[x]) for x in FORWARDED if x in headers)
+    forwarded.setdefault('Accept-Encoding', 'identity')
+    return forwarded
+
+def downstream_headers(headers):
+    """
+    Filter Graphite's response ``headers`` for sending on to our client.
+
+    Drops hop-by-hop headers, including any named in ``Connection``.
+    """
+    drop = set(HOP_BY_HOP)
+    for name in headers.get('Connection', '').split(','):
+        drop.add(name.strip().lower())
+    return [(x, y) for x, y in headers.items() if x.lower() not in drop]
+
+def cacheable_headers(headers):
+    return [(x, y) for x, y in headers if x.lower() not in UNCACHEABLE]
+
+def stream(response, sink=None, broadcast=None):
+    """
+    Yield ``response``'s body (still encoded) in chunks as it arrives.
+
+    Only one chunk is ever held in memory at a time. If given, ``sink`` (e.g.
+    a ``CacheWriter``) receives each chunk as well, and is committed once the
+    whole body has been read or aborted if anything goes wrong (including the
+    client going away mid-stream.)
+
+    If given, ``broadcast`` also receives each chunk, for other clients which
+    asked for the same render meanwhile; should our own client go away, the
+    rest of the body is still read for their benefit.
+    """
+    chunks = response.raw.stream(CHUNK_SIZE, decode_content=False)
+    complete = False
+    def consume(chunk):
+        if sink is not None:
+            sink.write(chunk)
+        if broadcast is not None:
+            broadcast.append(chunk)
+    try:
+        for chunk in chunks:
+            consume(chunk)
+            yield chunk
+        complete = True
+    finally:
+        if not complete and broadcast is not None and broadcast.followers:
+            try:
+                for chunk in chunks:
+                    consume(chunk)
+                complete = True
+            except Exception:
+                pass
+        response.close()
+        if broadcast is not None:
+            broadcast.finish()
+        if sink is not None:
+            if complete:
+                sink.commit()
+            else:
+                sink.abort()
+
+def discard(response, sink=None, broadcast=None):
+    """
+    Clean up as ``stream`` would have, for a body which was never read.
+    """
+    response.close()
+    if broadcast is not None:
+        broadcast.finish()
+    if sink is not None:
+        sink.abort()
+
+def stream_file(fd):
+    """
+    Yield the rest of open file ``fd`` in chunks, closing it when done.
+    """
+    with fd:
+        while True:
+            chunk = fd.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
@@ -0,0 +1,189 @@
+"""
+Compact storage for series returned by Graphite, and a streaming parser.
+
+A ``-7days`` render of a few dozen targets easily runs to millions of
+datapoints; as parsed JSON, each is a list of two Python objects. Series
+here keep just a start time, a step and a packed array of float values,
+with timestamps implied by position.
+"""
+from array import array
+import json
+import re
+
+
+NAN = float('nan')
+
+WHITESPACE = re.compile(r'\s*')
+# One [value, timestamp] pair, plus any separating comma before it
+POINT = re.compile(r'\s*,?\s*\[\s*([^,\s\]]+)\s*,\s*([^,\s\]]+)\s*\]')
+DECODER = json.JSONDecoder()
+
+
+class Series(object):
+    """
+    A single rendered series: ``values[i]`` is for ``start + i * step``.
+
+    Gaps (``null`` datapoints) are stored as NaN. ``stats`` is filled in by
+    ``summary.summarize``.
+    """
+    __slots__ = ('target', 'start', 'step', 'values', 'stats')
+
+    def __init__(self, target, start=None, step=None, values=None):
+        self.target = target
+        self.start = start
+        self.step = step
+        self.values = array('d') if values is None else values
+        self.stats = None
+
+    def __repr__(self):
+        return "<Series %r: %d points>" % (self.target, len(self.values))
+
+    def __len__(self):
+        return len(self.values)
+
+    def datapoints(self):
+        """
+        Return ``[value, timestamp]`` pairs as Graphite would (gaps as None.)
+        """
+        return [
+            [None if x != x else x, self.start + index * (self.step or 0)]
+            for index, x in enumerate(self.values)
+        ]
+
+
+def parse_render(chunks):
+    """
+    Parse the body of a ``format=json`` render into a list of Series.
+
+    ``chunks`` is an iterable of strings, e.g. ``response.iter_content()``.
+    Datapoints are packed into arrays as they're read, so neither the whole
+    body nor its datapoints as Python objects are ever held in memory.
+    """
+    return list(RenderParser(chunks).series())
+
+
+class RenderParser(object):
+    """
+    Incremental parser for Graphite's render JSON: a list of objects, each
+    with a ``target`` string and a (potentially huge) ``datapoints`` list.
+
+    Other keys (e.g. ``tags``) are skipped over.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def more(self):
+        """
+        Read another chunk into the buffer; return False at end of input.
+        """
+        if self.eof:
+            return False
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            return False
+        # Drop whatever's already been parsed
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace, returning the next character ('' at end of input.)
+        """
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.more():
+                return ""
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError("Expected %r but found %r" % (char, found))
+        self.pos += 1
+
+    def value(self):
+        """
+        Decode the next (complete) JSON value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = DECODER.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self.more():
+                    raise
+                continue
+            # A number at the very end of the buffer may continue in the next
+            # chunk
+            if end == len(self.buffer) and self.more():
+                continue
+            self.pos = end
+            return value
+
+    def series(self):
+        self.expect('[')
+        while True:
+            char = self.peek()
+            if char == ']':
+                self.pos += 1
+                return
+            if char == ',':
+                self.pos += 1
+                continue
+            yield self.one()
+
+    def one(self):
+        series = Series(None)
+        self.expect('{')
+        while True:
+            char = self.peek()
+            if char == '}':
+                self.pos += 1
+                return series
+            if char == ',':
+                self.pos += 1
+                continue
+            key = self.value()
+            self.expect(':')
+            if key == 'datapoints':
+                self.points(series)
+            elif key == 'target':
+                series.target = self.value()
+            else:
+                self.value()
+
+    def points(self, series):
+        self.expect('[')
+        values = series.values
+        timestamps = []
+        match = POINT.match
+        while True:
+            buffer, pos = self.buffer, self.pos
+            point = match(buffer, pos)
+            while point is not None:
+                value, timestamp = point.groups()
+                values.append(NAN if value == 'null' else float(value))
+                # Only the first two timestamps are needed, for start & step
+                if len(timestamps) < 2:
+                    timestamps.append(int(float(timestamp)))
+                pos = point.end()
+                point = match(buffer, pos)
+            self.pos = pos
+            char = self.peek()
+            if char == ']':
+                self.pos += 1
+                break
+            # Partial datapoint at the end of the buffer
+            if not self.more():
+                raise ValueError("Truncated datapoints for %r" % series.target)
+        if timestamps:
+            series.start = timestamps[0]
+        if len(timestamps) > 1:
+            series.step = timestamps[1] - timestamps[0]
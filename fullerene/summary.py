@@ -0,0 +1,123 @@
+"""
+Summary statistics (min/max/etc) for series returned by Graphite.
+
+Uses NumPy, if installed, to summarize every series in a render at once;
+otherwise falls back to plain Python, which gives the same results (only
+more slowly for long or numerous series.)
+"""
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Statistics computed for each series, in order
+STATS = ('min', 'max', 'mean', 'last', 'p95', 'p99')
+PERCENTILES = (95, 99)
+
+# Value suffixes used when formatting, largest first
+PREFIXES = (
+    (1e12, 'T'),
+    (1e9, 'G'),
+    (1e6, 'M'),
+    (1e3, 'K'),
+)
+
+
+def summarize(series):
+    """
+    Fill in ``stats`` on each of ``series`` (``series.Series`` objects.)
+
+    Each ``stats`` is a dict mapping the names in ``STATS`` to numbers
+    (``None`` where a series has no data), plus ``formatted``: the same, as
+    display strings. Gaps (NaN values) are ignored. Returns ``series``.
+    """
+    columns = [item.values for item in series]
+    if numpy is not None:
+        rows = _summarize_numpy(columns)
+    else:
+        rows = map(_summarize_python, columns)
+    for item, row in zip(series, rows):
+        stats = dict(zip(STATS, row))
+        stats['formatted'] = dict(
+            (name, format_value(value)) for name, value in stats.items()
+        )
+        item.stats = stats
+    return series
+
+def format_value(value):
+    """
+    Format ``value`` for display, e.g. ``1234567`` => ``"1.23M"``.
+    """
+    if value is None:
+        return ""
+    for size, prefix in PREFIXES:
+        if abs(value) >= size:
+            return "%.2f%s" % (value / size, prefix)
+    return "%.2f" % value
+
+
+def _summarize_numpy(columns):
+    """
+    Summarize all ``columns`` in one go, as rows of a NaN-padded 2D array.
+    """
+    if not columns:
+        return []
+    width = max(len(x) for x in columns) or 1
+    data = numpy.full((len(columns), width), numpy.nan)
+    for row, values in enumerate(columns):
+        # Packed arrays can be copied in without any per-value work
+        if len(values):
+            data[row, :len(values)] = numpy.frombuffer(values, dtype=float)
+    valid = ~numpy.isnan(data)
+    counts = valid.sum(axis=1)
+    empty = counts == 0
+    rows = numpy.arange(len(columns))
+    # Masked equivalents of min/max/mean, without all-NaN warnings
+    minimums = numpy.where(valid, data, numpy.inf).min(axis=1)
+    maximums = numpy.where(valid, data, -numpy.inf).max(axis=1)
+    totals = numpy.where(valid, data, 0).sum(axis=1)
+    means = totals / numpy.maximum(counts, 1)
+    # Last non-null value: first valid one counting back from the end
+    lasts = data[rows, width - 1 - valid[:, ::-1].argmax(axis=1)]
+    # Percentiles by linear interpolation, as numpy.percentile does; sorting
+    # puts each row's NaNs after all its values
+    ordered = numpy.sort(data, axis=1)
+    top = numpy.maximum(counts - 1, 0)
+    percentiles = []
+    for percent in PERCENTILES:
+        rank = top * (percent / 100.0)
+        lower = numpy.floor(rank).astype(int)
+        upper = numpy.minimum(lower + 1, top)
+        low, high = ordered[rows, lower], ordered[rows, upper]
+        percentiles.append(low + (high - low) * (rank - lower))
+    results = numpy.column_stack(
+        [minimums, maximums, means, lasts] + percentiles
+    )
+    return [
+        [None] * len(STATS) if missing else map(float, row)
+        for missing, row in zip(empty, results)
+    ]
+
+def _summarize_python(values):
+    # NaN is the only value not equal to itself
+    present = [x for x in values if x == x]
+    if not present:
+        return [None] * len(STATS)
+    ordered = sorted(present)
+    row = [
+        ordered[0],
+        ordered[-1],
+        math.fsum(present) / len(present),
+        present[-1],
+    ]
+    top = len(ordered) - 1
+    for percent in PERCENTILES:
+        rank = top * (percent / 100.0)
+        lower = int(math.floor(rank))
+        upper = min(lower + 1, top)
+        low, high = ordered[lower], ordered[upper]
+        row.append(low + (high - low) * (rank - lower))
+    return [float(x) for x in row]
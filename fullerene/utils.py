@@ -1,5 +1,79 @@
+import re
+
+
 def dots(string):
     return string.replace('_', '.')
 
 def sliced(string, *args):
     return '.'.join(string.split('.')[slice(*args)])
+
+def freeze(value):
+    """
+    Return a hashable, order-independent copy of a YAML-ish ``value``.
+
+    Dicts become sorted tuples of pairs and lists become tuples, recursively,
+    so that equal structures (e.g. two identical metric definitions) produce
+    equal keys.
+    """
+    if hasattr(value, 'items'):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(x) for x in value)
+    return value
+
+def is_pattern(string):
+    """
+    Does ``string`` contain any Graphite wildcard/brace syntax?
+    """
+    return any(x in string for x in '*?[{')
+
+def glob_to_regex(pattern):
+    """
+    Translate a Graphite path pattern into an anchored regular expression.
+
+    Supports ``*``, ``?``, ``[...]`` character classes and ``{a,b}``
+    alternation. As in Graphite, wildcards never match across a period.
+    """
+    return re.compile(glob_to_pattern(pattern) + r'\Z')
+
+def glob_to_pattern(pattern):
+    """
+    Like ``glob_to_regex`` but returns an unanchored, uncompiled regex string.
+    """
+    regex = []
+    in_braces = False
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '*':
+            regex.append('[^.]*')
+        elif char == '?':
+            regex.append('[^.]')
+        elif char == '[':
+            end = pattern.find(']', i + 1)
+            if end == -1:
+                regex.append(re.escape(char))
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                regex.append('[%s]' % body.replace('\\', '\\\\'))
+                i = end
+        elif char == '{' and not in_braces:
+            in_braces = True
+            regex.append('(?:')
+        elif char == '}' and in_braces:
+            in_braces = False
+            regex.append(')')
+        elif char == ',' and in_braces:
+            regex.append('|')
+        else:
+            regex.append(re.escape(char))
+        i += 1
+    return ''.join(regex)
+
+def chunked(items, size):
+    """
+    Split list ``items`` into consecutive lists of at most ``size`` items.
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
@@ -1,4 +1,4 @@
-from fullerene import app, CONFIG
+from fullerene import app
 
 
-app.run(host='0.0.0.0', port=8080, debug=True, extra_files=(CONFIG,))
+app.run(host='0.0.0.0', port=8080, debug=True)
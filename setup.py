@@ -11,5 +11,7 @@ setup(
     packages=find_packages(),
     #test_suite='nose.collector',
     tests_require=['nose', 'mock', 'rudolf'],
-    install_requires=['requests >=0.7.3', 'flask', 'pyyaml'],
+    install_requires=['requests >=2.12', 'flask', 'pyyaml'],
+    # Faster stats for pages with many or long series
+    extras_require={'numpy': ['numpy']},
 )
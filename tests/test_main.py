@@ -1,13 +1,39 @@
+from array import array
+import json
+import math
+import os
+import shutil
 import sys
+import tempfile
+import threading
+import time
 
 import os.path
 
 import mock
-from nose.tools import eq_, raises
+import requests
+from werkzeug.datastructures import MultiDict
+from nose.tools import eq_, ok_, raises
 from nose.plugins.skip import SkipTest
 
+# The app module loads its config at import time
+os.environ.setdefault('FULLERENE_CONFIG',
+    os.path.join(os.path.dirname(__file__), "support", "app.yml"))
+import fullerene
 from fullerene.metric import Metric, combine
-from fullerene.config import Config
+from fullerene.cache import (DiskCache, PageCache, TTLCache, relative_seconds,
+    render_ttl, uncacheable)
+from fullerene.concurrency import Broadcast, SingleFlight
+from fullerene.config import Config, ConfigFile
+from fullerene.graph import Graph
+from fullerene.graphite import Graphite, endpoint, stats_window
+from fullerene import instrument
+from fullerene.profiling import Profile
+from fullerene import summary
+from fullerene.series import Series, parse_render
+from fullerene.proxy import downstream_headers, stream, upstream_headers
+from fullerene.index import HostIndex, MetricIndex
+from fullerene.utils import glob_to_regex
 
 
 def conf(name):
@@ -47,6 +73,20 @@ class TestMetrics(object):
                 ),
                 "foo.2.bar.biz.baz"
             ),
+            ("Glob-style excludes",
+                "globbed",
+                (
+                    # Matches glob in 1st wildcard slot
+                    "foo.devshm.bar.x",
+                    # Matches character class in 2nd (final) wildcard slot
+                    "foo.root.bar.1",
+                    # Matches literal in 2nd wildcard slot
+                    "foo.root.bar.tmp",
+                    # Only partially matches excludes
+                    "foo.root.bar.tmpfs",
+                ),
+                "foo.root.bar.tmpfs"
+            ),
         ):
             graphite = mock.Mock()
             graphite.query.return_value = expansions
@@ -55,6 +95,40 @@ class TestMetrics(object):
                 yield eq_, map(str, config.metrics[name].graphs()), [result]
                 del eq_.description
 
+    def test_graphs_for_hosts(self):
+        config = conf("exclusions")
+        graphite = mock.Mock()
+        graphite.query.return_value = [
+            "db1_example_com.foo.1.bar", "db1_example_com.foo.3.bar",
+            "web1.foo.2.bar", "web1.foo.4.bar", "web1.foo.5.bar",
+        ]
+        with mock.patch.object(config, 'graphite', graphite):
+            metric = config.metrics['implicit']
+            result = metric.graphs_for_hosts(
+                ["web1", "db1.example.com", "idle"])
+        graphite.query.assert_called_once_with(
+            "{db1_example_com,idle,web1}.foo.*.bar")
+        eq_(
+            dict((k, map(str, v)) for k, v in result.items()),
+            {
+                "db1.example.com": ["db1_example_com.foo.3.bar"],
+                "web1": ["web1.foo.{4,5}.bar"],
+                "idle": [],
+            }
+        )
+
+    def test_expand_hosts_chunks_queries(self):
+        config = conf("exclusions")
+        graphite = mock.Mock()
+        graphite.query.return_value = []
+        hosts = ["h%03d" % x for x in range(120)]
+        with mock.patch.object(config, 'graphite', graphite):
+            config.metrics['implicit'].expand_hosts(hosts)
+        # One request per chunk, so no URL grows with the number of hosts
+        eq_(graphite.query.call_count, 3)
+        eq_(graphite.query.call_args, mock.call(
+            "{%s}.foo.*.bar" % ",".join(hosts[100:])))
+
     def test_combinations(self):
         for desc, inputs, results in (
             ("Single metric, no combinations",
@@ -113,6 +187,1021 @@ class TestMetrics(object):
             }
         )
 
+    def test_include_raw_sparse_expansions(self):
+        """
+        combine() never outputs expanded combinations absent from the input
+        """
+        result = combine(["a.x.1", "b.y.2"], [0, 2], True)
+        eq_(result, {"a.{x,y}.1": ["a.x.1"], "b.{x,y}.2": ["b.y.2"]})
+
+
+class TestGraphite(object):
+    def test_fetch_stats(self):
+        """
+        fetch_stats fills in each Graph's stats
+        """
+        graphite = Graphite("uri", [])
+        graphs = [Graph("foo.bar"), Graph("biz.baz")]
+        with mock.patch.object(graphite, '_stats_chunk') as chunk:
+            chunk.side_effect = lambda targets, window: [[x] for x in targets]
+            eq_(graphite.fetch_stats(graphs), True)
+        eq_([g.stats for g in graphs], [["foo.bar"], ["biz.baz"]])
+
+    def test_fetch_stats_deadline(self):
+        """
+        fetch_stats leaves stragglers and errors with empty stats
+        """
+        graphite = Graphite("uri", [], stats_timeout=0.1)
+        def chunk(targets, window):
+            if targets == ["slow(x)"]:
+                time.sleep(1)
+            elif targets == ["broken(x)"]:
+                raise ValueError
+            return [["ok"]]
+        graphs = [Graph("slow(x)"), Graph("broken(x)"), Graph("fast(x)")]
+        with mock.patch.object(graphite, '_stats_chunk', side_effect=chunk):
+            eq_(graphite.fetch_stats(graphs), False)
+        eq_([g.stats for g in graphs], [[], [], ["ok"]])
+
+    def test_prefetch_stats(self):
+        """
+        prefetch_stats returns at once; each Graph waits for its own render
+        """
+        graphite = Graphite("uri", [], stats_batch_size=1, stats_timeout=0.5)
+        release = threading.Event()
+        def chunk(targets, window):
+            if targets == ["slow.x"]:
+                release.wait()
+            return [targets]
+        graphs = [Graph("slow.x"), Graph("fast.x")]
+        with mock.patch.object(graphite, '_stats_chunk', side_effect=chunk):
+            graphite.prefetch_stats(graphs)
+            eq_(graphs[1].stats, ["fast.x"])
+            release.set()
+            eq_(graphs[0].stats, ["slow.x"])
+
+    def test_stats_batch_windows(self):
+        """
+        stats_batch renders once per time window, plus once per function
+        """
+        graphite = Graphite("uri", [])
+        with mock.patch.object(graphite, '_stats_chunk') as chunk:
+            chunk.side_effect = lambda targets, window: [[x] for x in targets]
+            graphite.stats_batch([
+                {'target': 'a.b', 'from': '-4hours'},
+                {'target': 'a.c', 'from': '-4hours'},
+                {'target': 'a.d', 'from': '-1days'},
+                {'target': 'sum(a.*)', 'from': '-4hours'},
+            ])
+        eq_(
+            sorted(x[0] for x in chunk.call_args_list),
+            [
+                (['a.b', 'a.c'], (('from', '-4hours'),)),
+                (['a.d'], (('from', '-1days'),)),
+                (['sum(a.*)'], (('from', '-4hours'),)),
+            ]
+        )
+
+    def test_stats_batch_size(self):
+        """
+        stats_batch splits large windows into batch_size chunks
+        """
+        graphite = Graphite("uri", [], stats_batch_size=2)
+        with mock.patch.object(graphite, '_stats_chunk') as chunk:
+            chunk.side_effect = lambda targets, window: [[x] for x in targets]
+            result = graphite.stats_batch([{'target': x} for x in "abcde"])
+        eq_(chunk.call_count, 3)
+        eq_(result, [[x] for x in "abcde"])
+
+    def test_stats_chunk_demultiplexes(self):
+        """
+        Multi-target stats renders are split back up by target
+        """
+        graphite = Graphite("uri", [])
+        response = mock.Mock(headers={})
+        response.iter_content.return_value = [json.dumps([
+            {'target': 'a.b.x', 'datapoints': []},
+            {'target': 'a.c', 'datapoints': []},
+            {'target': 'a.b.y', 'datapoints': []},
+        ])]
+        with mock.patch.object(graphite, 'session') as session:
+            session.get.return_value = response
+            result = graphite._stats_chunk(['a.b.*', 'a.{c,d}'], ())
+        eq_(
+            [[x.target for x in series] for series in result],
+            [['a.b.x', 'a.b.y'], ['a.c']]
+        )
+
+    def test_stats_window(self):
+        """
+        Stats renders ask for one datapoint per pixel of graph width
+        """
+        eq_(
+            stats_window({'from': '-7days', 'width': 400, 'height': 250}),
+            (('from', '-7days'), ('maxDataPoints', 400))
+        )
+
+    def test_requests_use_shared_session(self):
+        """
+        Upstream requests go through the pooled session, with timeouts
+        """
+        graphite = Graphite("http://graphite", [], connect_timeout=1,
+            read_timeout=2)
+        response = mock.Mock()
+        response.content = json.dumps({'results': ['a.b']})
+        with mock.patch.object(graphite, 'session') as session:
+            session.get.return_value = response
+            eq_(graphite.query("a.*", leaves_only=True), ['a.b'])
+        session.get.assert_called_once_with(
+            "http://graphite/metrics/expand/",
+            params=[('query', 'a.*'), ('leavesOnly', 1)],
+            timeout=(1, 2)
+        )
+
+    def test_query_is_cached(self):
+        """
+        Repeated queries are answered from cache until invalidated
+        """
+        graphite = Graphite("http://graphite", [])
+        response = mock.Mock()
+        response.content = json.dumps({'results': ['a.b']})
+        with mock.patch.object(graphite, 'session') as session:
+            session.get.return_value = response
+            graphite.query("a.*")
+            eq_(graphite.query("a.*"), ['a.b'])
+            eq_(session.get.call_count, 1)
+            graphite.query("a.*", leaves_only=True)
+            eq_(session.get.call_count, 2)
+            graphite.invalidate("a.*")
+            graphite.query("a.*")
+            eq_(session.get.call_count, 3)
+
+    def test_query_uses_loaded_index(self):
+        """
+        Queries are answered by the local metric index once it's loaded
+        """
+        graphite = Graphite("http://graphite", ["b"], index_refresh=60)
+        graphite.index.root = graphite.index.build(["a.x", "b.x", "c.y"])
+        with mock.patch.object(graphite.index, 'start'):
+            with mock.patch.object(graphite, 'session') as session:
+                eq_(graphite.query("*", "a.*"), ["a", "a.x", "c"])
+        eq_(session.get.call_count, 0)
+
+    def test_concurrent_queries_coalesce(self):
+        graphite = Graphite("http://graphite", [])
+        def get(*args, **kwargs):
+            time.sleep(0.2)
+            return mock.Mock(content=json.dumps({'results': ['a.b']}))
+        with mock.patch.object(graphite, 'session') as session:
+            session.get.side_effect = get
+            threads = [
+                threading.Thread(target=graphite.query, args=("a.*",))
+                for _ in range(5)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        eq_(session.get.call_count, 1)
+
+
+class TestBackends(object):
+    def setup(self):
+        self.graphite = Graphite(["http://a", "http://b", "http://c"], [],
+            failure_threshold=1)
+
+    def respond(self, results):
+        """
+        Fake session.get answering with ``results[uri]``.
+        """
+        def get(url, **kwargs):
+            for uri, result in results.items():
+                if url.startswith(uri):
+                    if isinstance(result, Exception):
+                        raise result
+                    return result
+        return get
+
+    def test_first_backend_is_uri(self):
+        eq_(self.graphite.uri, "http://a")
+        eq_(Graphite("http://a", []).uri, "http://a")
+
+    def test_lookups_fail_over(self):
+        results = {
+            "http://a": requests.ConnectionError(),
+            "http://b": mock.Mock(status_code=503, content=""),
+            "http://c": mock.Mock(status_code=200,
+                content=json.dumps({'results': ['x.1', 'x.2']})),
+        }
+        with mock.patch.object(self.graphite, 'session') as session:
+            session.get.side_effect = self.respond(results)
+            eq_(self.graphite.query("x.*"), ['x.1', 'x.2'])
+        # Replicas: one answer is the whole answer, and is cached
+        eq_(len(self.graphite.expansions), 1)
+        eq_([x.healthy for x in self.graphite.backends], [False, False, True])
+
+    def test_renders_take_turns(self):
+        with mock.patch.object(self.graphite, 'session') as session:
+            session.get.return_value = mock.Mock(status_code=200, content="")
+            for _ in range(6):
+                self.graphite.get("/render/", params={'target': 'x'})
+        urls = [x[0][0] for x in session.get.call_args_list]
+        eq_(sorted(set(urls[:3])), ["http://a/render/", "http://b/render/",
+            "http://c/render/"])
+        eq_(urls[:3], urls[3:])
+
+    def test_renders_fail_over(self):
+        ok = mock.Mock(status_code=200, content="")
+        results = {
+            "http://a": requests.ConnectionError(),
+            "http://b": mock.Mock(status_code=502, content=""),
+            "http://c": ok,
+        }
+        with mock.patch.object(self.graphite, 'session') as session:
+            session.get.side_effect = self.respond(results)
+            for _ in range(3):
+                eq_(self.graphite.get("/render/"), ok)
+        # Once marked down, a and b are skipped
+        eq_(session.get.call_count, 3 + 1 + 1)
+
+    @raises(requests.ConnectionError)
+    def test_all_backends_failing(self):
+        with mock.patch.object(self.graphite, 'session') as session:
+            session.get.side_effect = requests.ConnectionError()
+            self.graphite.get("/render/")
+
+
+class TestCrawl(object):
+    # Branch => children, as (name, leaf, branch)
+    tree = {
+        "": [("host1", False, True), ("host2", False, True),
+            ("excluded", False, True)],
+        "host1": [("cpu", False, True), ("load", True, True)],
+        "host1.cpu": [("user", True, False), ("system", True, False)],
+        "host1.load": [("shortterm", True, False)],
+        "host2": [("uptime", True, False)],
+    }
+
+    def setup(self):
+        self.graphite = Graphite("uri", ["excluded"])
+        self.queries = []
+        self.graphite.find = self.find
+
+    def find(self, query):
+        self.queries.append(query)
+        parent = query[:-2] if query.endswith(".*") else ""
+        if query != "*" and not query.endswith(".*"):
+            # A prefix: find the node itself
+            parent, _, name = query.rpartition(".")
+            return [
+                (query, leaf, branch)
+                for child, leaf, branch in self.tree[parent]
+                if child == name
+            ]
+        return [
+            ((parent + "." if parent else "") + name, leaf, branch)
+            for name, leaf, branch in self.tree.get(parent, [])
+        ]
+
+    def test_crawls_everything(self):
+        eq_(
+            list(self.graphite.crawl()),
+            ["host1.load", "host2.uptime", "host1.cpu.user",
+                "host1.cpu.system", "host1.load.shortterm"]
+        )
+
+    def test_only_branches_are_expanded(self):
+        list(self.graphite.crawl())
+        eq_(
+            sorted(self.queries),
+            ["*", "host1.*", "host1.cpu.*", "host1.load.*", "host2.*"]
+        )
+
+    def test_prefix_and_depth(self):
+        eq_(list(self.graphite.crawl("host1", max_depth=1)), ["host1.load"])
+        eq_(
+            sorted(self.graphite.crawl("host1")),
+            ["host1.cpu.system", "host1.cpu.user", "host1.load",
+                "host1.load.shortterm"]
+        )
+
+    def test_bounded_concurrency(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'most': 0}
+        find = self.find
+        def slow_find(query):
+            with lock:
+                state['running'] += 1
+                state['most'] = max(state['most'], state['running'])
+            time.sleep(0.02)
+            with lock:
+                state['running'] -= 1
+            return find(query)
+        self.graphite.find = slow_find
+        eq_(len(list(self.graphite.crawl(concurrency=2))), 5)
+        eq_(state['most'], 2)
+
+    def test_stats_pool_left_alone(self):
+        self.graphite.pool = mock.Mock()
+        eq_(len(list(self.graphite.crawl())), 5)
+        ok_(not self.graphite.pool.submit.called)
+
+
+class TestMetricIndex(object):
+    paths = [
+        "web1.cpu.0.user", "web1.cpu.1.user", "web1.cpu.10.user",
+        "web1.df.root.free", "web1.df.dev.free", "web2.load.load.shortterm",
+        "web2.load", "db1.df.root.free",
+    ]
+
+    def test_expand(self):
+        index = MetricIndex(mock.Mock(), paths=self.paths)
+        for desc, pattern, leaves_only, results in (
+            ("Literal path", "web1.df.root.free", False, ["web1.df.root.free"]),
+            ("Missing path", "web1.df.nope", False, []),
+            ("Top-level wildcard", "*", False, ["db1", "web1", "web2"]),
+            ("Wildcard in middle",
+                "*.df.root.free", False,
+                ["db1.df.root.free", "web1.df.root.free"]),
+            ("Braces", "web1.df.{root,dev}.free", False,
+                ["web1.df.dev.free", "web1.df.root.free"]),
+            ("Character class", "web1.cpu.[0-9].user", False,
+                ["web1.cpu.0.user", "web1.cpu.1.user"]),
+            ("Branches included by default", "web2.*", False, ["web2.load"]),
+            ("Branches which are also leaves", "web2.load", True,
+                ["web2.load"]),
+            ("Leaves only", "web1.*", True, []),
+        ):
+            eq_.description = desc
+            yield eq_, index.expand(pattern, leaves_only), results
+            del eq_.description
+
+    def test_non_ascii_segments(self):
+        graphite = mock.Mock()
+        graphite.get.return_value.content = json.dumps(
+            [u"caf\xe9.load", "web1.load"])
+        index = MetricIndex(graphite)
+        index.refresh()
+        eq_(index.expand("*.load"), [u"caf\xe9.load", "web1.load"])
+        eq_(index.expand(u"caf\xe9.*"), [u"caf\xe9.load"])
+
+    def test_refresh_loads_index_json(self):
+        graphite = mock.Mock()
+        graphite.get.return_value.content = json.dumps(["a.b", "a.c"])
+        index = MetricIndex(graphite)
+        ok_(not index.ready)
+        index.refresh()
+        graphite.get.assert_called_once_with("/metrics/index.json")
+        eq_(index.expand("a.*"), ["a.b", "a.c"])
+
+
+class TestHostIndex(object):
+    def setup(self):
+        self.graphite = mock.Mock()
+        self.graphite.query.return_value = [
+            "web1_foo_com", "web2_foo_com", "db1_bar_org"
+        ]
+        self.index = HostIndex(self.graphite)
+
+    def test_by_domain(self):
+        with mock.patch.object(self.index, 'start'):
+            eq_(self.index.by_domain(), {
+                "foo.com": ["web1.foo.com", "web2.foo.com"],
+                "bar.org": ["db1.bar.org"],
+            })
+
+    def test_for_domain(self):
+        with mock.patch.object(self.index, 'start'):
+            eq_(self.index.for_domain("foo_com"), ["web1", "web2"])
+            eq_(self.index.for_domain("nope.com"), [])
+
+    def test_built_once(self):
+        """
+        Host index is only rebuilt by the background refresh
+        """
+        with mock.patch.object(self.index, 'start') as start:
+            self.index.by_domain()
+            self.index.for_domain("foo.com")
+        eq_(self.graphite.query.call_count, 1)
+        eq_(start.call_count, 2)
+
+
+class TestTTLCache(object):
+    def test_expiry(self):
+        cache = TTLCache(ttl=10)
+        cache.set('a', 1)
+        eq_(cache.get('a'), 1)
+        with mock.patch('time.time', return_value=time.time() + 11):
+            eq_(cache.get('a'), None)
+        eq_((cache.hits, cache.misses), (1, 1))
+
+    def test_lru_eviction(self):
+        cache = TTLCache(size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        eq_([cache.get(x) for x in "abc"], [1, None, 3])
+
+    def test_invalidate(self):
+        cache = TTLCache()
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.invalidate('a')
+        eq_(len(cache), 1)
+        cache.invalidate()
+        eq_(len(cache), 0)
+
+
+class TestPageCache(object):
+    def setup(self):
+        self.cache = PageCache(size=2, stale=60)
+        self.renders = []
+
+    def render(self, page):
+        def render():
+            self.renders.append(page)
+            return page
+        return render
+
+    def age(self, key, seconds):
+        expires, page = self.cache._data[key]
+        self.cache._data[key] = (expires - seconds, page)
+
+    def test_fresh_pages_are_reused(self):
+        eq_(self.cache.get("a", 10, self.render("one")), "one")
+        eq_(self.cache.get("a", 10, self.render("two")), "one")
+        eq_(self.renders, ["one"])
+
+    def test_stale_pages_are_served_while_regenerating(self):
+        self.cache.get("a", 10, self.render("one"))
+        self.age("a", 11)
+        eq_(self.cache.get("a", 10, self.render("two")), "one")
+        for _ in range(100):
+            if self.cache._data["a"][1] == "two":
+                break
+            time.sleep(0.01)
+        eq_(self.cache.get("a", 10, self.render("three")), "two")
+
+    def test_expired_pages_are_rendered_in_the_foreground(self):
+        self.cache.get("a", 10, self.render("one"))
+        self.age("a", 71)
+        eq_(self.cache.get("a", 10, self.render("two")), "two")
+
+    def test_uncacheable_pages_are_not_stored(self):
+        def partial():
+            uncacheable()
+            return "partial"
+        eq_(self.cache.get("a", 10, partial), "partial")
+        eq_(self.cache.get("a", 10, self.render("whole")), "whole")
+        eq_(self.cache.get("a", 10, self.render("again")), "whole")
+
+    def test_least_recently_used_pages_are_evicted(self):
+        for key in ("a", "b", "a", "c"):
+            self.cache.get(key, 10, self.render(key))
+        eq_(sorted(self.cache._data), ["a", "c"])
+
+
+class TestRenderCache(object):
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = DiskCache(self.directory, max_bytes=1200)
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_relative_seconds(self):
+        for value, expected in (
+            ("-4hours", 14400), ("-15min", 900), ("-1mon", 2592000),
+            ("-2d", 172800), ("now", None), ("20111001", None),
+        ):
+            yield eq_, relative_seconds(value), expected
+
+    def test_render_ttl(self):
+        for desc, params, expected in (
+            ("One pixel's worth of time",
+                {'from': '-4hours', 'width': 100}, 144),
+            ("Longer periods keep longer",
+                {'from': '-7days', 'width': 400}, 1512),
+            ("Bounded below", {'from': '-1hours', 'width': 400}, 60),
+            ("Fixed end in the past", {'from': '20110101', 'until': '20110102'},
+                86400),
+            ("Absolute start, ending now", {'from': '20110101'}, 60),
+        ):
+            eq_.description = desc
+            yield eq_, render_ttl(params), expected
+            del eq_.description
+
+    def test_key_normalization(self):
+        key = self.cache.key
+        eq_(
+            key(MultiDict([('a', 1), ('b', 2)])),
+            key(MultiDict([('b', 2), ('a', 1)]))
+        )
+        ok_(
+            key(MultiDict([('target', 'x'), ('target', 'y')]))
+            != key(MultiDict([('target', 'y'), ('target', 'x')]))
+        )
+
+    def test_roundtrip_and_expiry(self):
+        self.cache.set("abc", {'Content-Type': 'image/png'}, "PNG", 10)
+        eq_(self.cache.get("abc"), ({'Content-Type': 'image/png'}, "PNG"))
+        with mock.patch('time.time', return_value=time.time() + 11):
+            eq_(self.cache.get("abc"), None)
+        eq_(self.cache.get("nope"), None)
+
+    def test_lru_eviction(self):
+        for index, key in enumerate(["aa", "bb", "cc"]):
+            self.cache.set(key, {}, "x" * 300, 10)
+            os.utime(self.cache.path(key), (index, index))
+        # Touching "aa" makes "bb" the least recently used
+        self.cache.get("aa")
+        self.cache.set("dd", {}, "x" * 300, 10)
+        eq_(
+            [self.cache.get(x) is not None for x in ["aa", "bb", "cc", "dd"]],
+            [True, False, True, True]
+        )
+
+
+class TestProxy(object):
+    def test_upstream_headers(self):
+        eq_(
+            upstream_headers({'If-None-Match': 'x', 'Cookie': 'y'}),
+            {'If-None-Match': 'x', 'Accept-Encoding': 'identity'}
+        )
+
+    def test_downstream_headers(self):
+        headers = {
+            'Content-Type': 'image/png',
+            'Content-Encoding': 'gzip',
+            'Transfer-Encoding': 'chunked',
+            'Connection': 'close, X-Private',
+            'X-Private': 'yes',
+        }
+        eq_(
+            sorted(downstream_headers(headers)),
+            [('Content-Encoding', 'gzip'), ('Content-Type', 'image/png')]
+        )
+
+    def test_stream_commits_complete_bodies(self):
+        response = mock.Mock()
+        response.raw.stream.return_value = iter(["a", "b"])
+        sink = mock.Mock()
+        eq_(list(stream(response, sink)), ["a", "b"])
+        eq_(sink.write.call_args_list, [mock.call("a"), mock.call("b")])
+        ok_(sink.commit.called)
+        ok_(response.close.called)
+
+    def test_stream_aborts_partial_bodies(self):
+        response = mock.Mock()
+        response.raw.stream.return_value = iter(["a", "b"])
+        sink = mock.Mock()
+        body = stream(response, sink)
+        next(body)
+        body.close() # e.g. client disconnected
+        ok_(sink.abort.called)
+        ok_(not sink.commit.called)
+
+
+class AppTest(object):
+    """
+    Base for tests making requests against the app, with a mock Graphite.
+    """
+    def setup(self):
+        self.config = conf("app")
+        self.config.graphite = mock.Mock()
+        self.patcher = mock.patch.object(fullerene.config_file, 'config',
+            self.config)
+        self.patcher.start()
+        self.client = fullerene.app.test_client()
+
+    def teardown(self):
+        self.patcher.stop()
+
+
+class TestRenderRoute(AppTest):
+    def upstream(self, *chunks):
+        response = mock.Mock(status_code=200,
+            headers={'Content-Type': 'image/png'})
+        response.raw.stream.return_value = iter(chunks)
+        return response
+
+    def test_head_does_not_hold_up_later_gets(self):
+        head = self.upstream("PNG")
+        self.config.graphite.get.return_value = head
+        eq_(self.client.head('/render/?target=a', buffered=True).status_code,
+            200)
+        ok_(head.close.called)
+        eq_(fullerene.render_flights._flights, {})
+        self.config.graphite.get.return_value = self.upstream("PNG")
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            self.client.get('/render/?target=a', buffered=True).data))
+        thread.start()
+        thread.join(5)
+        eq_(results, ["PNG"])
+
+    def test_cached_renders_ask_for_gzip_or_nothing(self):
+        self.config.render_cache = mock.Mock()
+        self.config.render_cache.open.return_value = None
+        for sent, expected in (
+            ("br, deflate", "identity"),
+            ("gzip, deflate, br", "gzip"),
+        ):
+            self.config.graphite.get.return_value = self.upstream("PNG")
+            self.client.get('/render/?target=a', buffered=True,
+                headers={'Accept-Encoding': sent})
+            headers = self.config.graphite.get.call_args[1]['headers']
+            eq_(headers['Accept-Encoding'], expected)
+            eq_(self.config.render_cache.key.call_args[0][1],
+                expected == "gzip")
+
+
+class TestStatsRoute(AppTest):
+    def setup(self):
+        super(TestStatsRoute, self).setup()
+        self.config.graphite = Graphite("http://graphite", [],
+            stats_batch_size=2)
+        self.renders = []
+
+    def teardown(self):
+        self.config.graphite.close()
+        super(TestStatsRoute, self).teardown()
+
+    def render(self, path, params=None, **kwargs):
+        self.renders.append(params)
+        body = json.dumps([
+            {'target': y, 'datapoints': [[1, 0], [3, 60]]}
+            for x, y in params if x == 'target'
+        ])
+        response = mock.Mock()
+        response.iter_content.return_value = [body]
+        return response
+
+    def get(self, query, render=None):
+        with mock.patch.object(self.config.graphite, 'get',
+            render or self.render):
+            return self.client.get('/stats/?' + query)
+
+    def test_results_follow_target_order(self):
+        response = self.get("target=c&target=a&target=b")
+        eq_(len(self.renders), 2)
+        stats = json.loads(response.data)['stats']
+        eq_([[x['target'] for x in result] for result in stats],
+            [['c'], ['a'], ['b']])
+        eq_(stats[0][0]['stats']['mean'], 2)
+
+    def test_window_and_width_passed_through(self):
+        self.get("target=a&from=-7days&until=-1days&width=300")
+        params = self.renders[0]
+        ok_(('from', '-7days') in params)
+        ok_(('until', '-1days') in params)
+        ok_(('maxDataPoints', '300') in params)
+        ok_('width' not in dict(params))
+
+    def test_cached_like_graphs(self):
+        response = self.get("target=a&from=-7days")
+        eq_(response.cache_control.public, True)
+        eq_(response.cache_control.max_age,
+            render_ttl({'from': '-7days'}, *self.config.render_ttl))
+
+    def test_failures_are_not_cached(self):
+        def failing(path, params=None, **kwargs):
+            if ('target', 'b') in params:
+                raise requests.ConnectionError
+            return self.render(path, params, **kwargs)
+        self.config.graphite.stats_batch_size = 1
+        response = self.get("target=a&target=b&from=-7days", failing)
+        eq_(json.loads(response.data)['stats'][1], [])
+        ok_(response.cache_control.no_store)
+        ok_(not response.cache_control.public)
+        eq_(response.cache_control.max_age, None)
+
+
+class TestPages(AppTest):
+    def setup(self):
+        super(TestPages, self).setup()
+        self.config.graphite.query.return_value = [
+            "web1.load.load.shortterm", "web2.load.load.shortterm",
+        ]
+        self.config.graphite.stats.return_value = []
+
+    def test_stats_fetched_with_page(self):
+        page = self.client.get('/main/web/').data
+        ok_(self.config.graphite.fetch_stats.called)
+        ok_('data-stats-target' not in page)
+
+    def test_pages_with_failed_stats_are_not_cached(self):
+        self.config.page_cache = PageCache()
+        self.config.graphite.fetch_stats.return_value = False
+        self.client.get('/main/web/')
+        self.client.get('/main/web/')
+        eq_(self.config.graphite.fetch_stats.call_count, 2)
+        self.config.graphite.fetch_stats.return_value = True
+        self.client.get('/main/web/')
+        self.client.get('/main/web/')
+        eq_(self.config.graphite.fetch_stats.call_count, 3)
+
+    def test_deferred_stats_left_to_browser(self):
+        self.config.defer_stats = True
+        page = self.client.get('/main/web/').data
+        ok_(not self.config.graphite.fetch_stats.called)
+        ok_(not self.config.graphite.prefetch_stats.called)
+        ok_('data-stats-target="{web1,web2}.load.load.shortterm"' in page)
+        ok_('data-stats-width="400"' in page)
+
+
+    def test_streamed_page_starts_before_graphs_are_built(self):
+        self.config.streaming = True
+        for url in ('/main/web/', '/main/web/load/'):
+            self.config.graphite.reset_mock()
+            response = self.client.get(url)
+            body = iter(response.response)
+            ok_('<html' in next(body))
+            ok_(not self.config.graphite.query.called)
+            rest = "".join(body)
+            ok_(self.config.graphite.query.called)
+            ok_('load.load.shortterm' in rest)
+            response.close()
+
+
+class TestSingleFlight(object):
+    def run_concurrently(self, func, count=5):
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(func()))
+            for _ in range(count)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_calls_coalesce(self):
+        flights = SingleFlight()
+        calls = []
+        def slow():
+            calls.append(1)
+            time.sleep(0.2)
+            return "result"
+        results = self.run_concurrently(lambda: flights.do("key", slow))
+        eq_(results, ["result"] * 5)
+        eq_(len(calls), 1)
+
+    def test_errors_are_shared(self):
+        flights = SingleFlight()
+        def broken():
+            time.sleep(0.2)
+            raise ValueError
+        def call():
+            try:
+                flights.do("key", broken)
+            except ValueError:
+                return "raised"
+        eq_(self.run_concurrently(call), ["raised"] * 5)
+
+    def test_sequential_calls_do_not_coalesce(self):
+        flights = SingleFlight()
+        func = mock.Mock(return_value=1)
+        flights.do("key", func)
+        flights.do("key", func)
+        eq_(func.call_count, 2)
+
+    def test_broadcast(self):
+        broadcast = Broadcast()
+        def leader():
+            time.sleep(0.1)
+            broadcast.start("head")
+            for chunk in "abc":
+                time.sleep(0.05)
+                broadcast.append(chunk)
+            broadcast.finish()
+        threading.Thread(target=leader).start()
+        eq_(broadcast.wait(), "head")
+        eq_("".join(broadcast.follow()), "abc")
+
+    def test_broadcast_replay_is_bounded(self):
+        broadcast = Broadcast(limit=4)
+        broadcast.start("head")
+        eq_(broadcast.wait(), "head")
+        follower = broadcast.follow()
+        for chunk in "abcdef":
+            broadcast.append(chunk)
+        eq_(next(follower), "a")
+        # Too late to replay from the start
+        eq_(broadcast.wait(), None)
+        eq_(broadcast.chunks, list("bcdef"))
+        eq_(next(follower), "b")
+        follower.close()
+        # Nobody left to buffer for
+        broadcast.append("g")
+        eq_(broadcast.chunks, [])
+
+
+class TestInstrumentation(object):
+    def teardown(self):
+        instrument.activate(None)
+
+    def test_endpoint_names(self):
+        for path, params, expected in (
+            ("/metrics/expand/", [('query', 'a.*')], "expand"),
+            ("/metrics/index.json", None, "index"),
+            ("/render/", {'target': 'a.b'}, "render"),
+            ("/render/", [('target', 'a.b'), ('format', 'json')], "stats"),
+        ):
+            yield eq_, endpoint(path, params), expected
+
+    def test_server_timing(self):
+        timings = instrument.Timings("host")
+        timings.add("expand", 0.010, 100)
+        timings.add("expand", 0.005, 50)
+        timings.add("stats", 0.020)
+        header = timings.server_timing()
+        ok_(header.startswith(
+            'expand;dur=15.0;desc="2 calls, 150 bytes", '
+            'stats;dur=20.0;desc="1 call", total;dur='
+        ), header)
+
+    def test_bound_calls_record_into_callers_timings(self):
+        timings = instrument.Timings("host")
+        instrument.activate(timings)
+        func = instrument.bind(lambda: instrument.record("expand", 0.1))
+        thread = threading.Thread(target=func)
+        thread.start()
+        thread.join()
+        eq_(timings.entries["expand"][0], 1)
+
+    def test_prometheus(self):
+        registry = instrument.Registry()
+        registry.observe("host", "expand", 0.02, 10)
+        registry.observe_request("host", 0.3)
+        text = registry.prometheus()
+        for line in (
+            'fullerene_upstream_seconds_bucket{route="host",endpoint="expand",le="0.01"} 0',
+            'fullerene_upstream_seconds_bucket{route="host",endpoint="expand",le="0.025"} 1',
+            'fullerene_upstream_seconds_count{route="host",endpoint="expand"} 1',
+            'fullerene_upstream_bytes_total{route="host",endpoint="expand"} 10',
+            'fullerene_request_seconds_bucket{route="host",le="+Inf"} 1',
+        ):
+            ok_(line in text.splitlines(), line)
+
+    def test_timed_phases(self):
+        timings = instrument.Timings("host")
+        instrument.activate(timings)
+        with instrument.timed("template"):
+            pass
+        with instrument.timed("template"):
+            pass
+        eq_(timings.entries["template"][0], 2)
+
+    def test_timed_without_request_is_a_noop(self):
+        with instrument.timed("template"):
+            pass
+
+    def test_profile_report(self):
+        timings = instrument.Timings("host")
+        instrument.activate(timings)
+        profile = Profile("host")
+        with instrument.timed("metric_expand"):
+            sorted(range(100))
+        profile.stop()
+        report = profile.report(timings)
+        ok_(report.startswith("Profile of host"), report)
+        ok_("metric_expand" in report, report)
+        ok_("cumulative" in report, report)
+
+
+class TestGraph(object):
+    def test_stats_are_lazy(self):
+        """
+        Graph stats aren't fetched until accessed, and then only once
+        """
+        config = mock.Mock()
+        config.graphite.stats.return_value = ["stats"]
+        graph = Graph("foo.bar", config)
+        eq_(config.graphite.stats.call_count, 0)
+        eq_(graph.stats, ["stats"])
+        eq_(graph.stats, ["stats"])
+        eq_(config.graphite.stats.call_count, 1)
+
+    def test_prefetched_stats_are_not_refetched(self):
+        """
+        Graphite.fetch_stats skips graphs whose stats were already fetched
+        """
+        graph = Graph("foo.bar")
+        graph.stats = ["cached"]
+        graphite = Graphite("uri", [])
+        with mock.patch.object(graphite, 'stats') as stats:
+            graphite.fetch_stats([graph])
+        eq_(stats.call_count, 0)
+        eq_(graph.stats, ["cached"])
+
+
+def series(target, *values):
+    values = [float('nan') if x is None else x for x in values]
+    return Series(target, 0, 60, array('d', values))
+
+
+class TestSummary(object):
+    def summarize(self):
+        return summary.summarize([
+            series("a", 1, None, 3, 2, None),
+            series("b", *range(1, 101)),
+            series("c", None, None),
+            series("d"),
+        ])
+
+    def check(self, result):
+        a, b, c, d = [x.stats for x in result]
+        eq_([a[x] for x in summary.STATS], [1, 3, 2, 2, 2.9, 2.98])
+        eq_(b['mean'], 50.5)
+        eq_(round(b['p95'], 2), 95.05)
+        eq_(round(b['p99'], 2), 99.01)
+        eq_(b['last'], 100)
+        eq_(c['min'], None)
+        eq_(d['formatted']['mean'], "")
+
+    def test_pure_python(self):
+        with mock.patch.object(summary, 'numpy', None):
+            self.check(self.summarize())
+
+    def test_numpy(self):
+        if summary.numpy is None:
+            raise SkipTest
+        self.check(self.summarize())
+
+    def test_format_value(self):
+        for value, expected in (
+            (None, ""),
+            (0, "0.00"),
+            (999.994, "999.99"),
+            (1234567, "1.23M"),
+            (-2500, "-2.50K"),
+            (3e12, "3.00T"),
+        ):
+            yield eq_, summary.format_value(value), expected
+
+
+class TestSeries(object):
+    body = json.dumps([
+        {'target': 'a.b', 'tags': {'name': 'a.b'},
+            'datapoints': [[1.5, 600], [None, 660], [-2e3, 720]]},
+        {'datapoints': [[7, 600]], 'target': 'a.c'},
+        {'target': 'a.d', 'datapoints': []},
+    ])
+
+    def check(self, result):
+        eq_([x.target for x in result], ['a.b', 'a.c', 'a.d'])
+        eq_(map(len, result), [3, 1, 0])
+        a, c, d = result
+        eq_((a.start, a.step), (600, 60))
+        eq_(a.values[0], 1.5)
+        ok_(math.isnan(a.values[1]))
+        eq_(a.values[2], -2000)
+        eq_(a.datapoints(), [[1.5, 600], [None, 660], [-2000, 720]])
+        eq_((c.start, c.step), (600, None))
+
+    def test_parse_render(self):
+        self.check(parse_render([self.body]))
+
+    def test_parse_render_in_chunks(self):
+        """
+        Render bodies may be split up anywhere
+        """
+        for size in (1, 2, 3, 7, 16):
+            chunks = [
+                self.body[x:x + size] for x in range(0, len(self.body), size)
+            ]
+            yield self.check, parse_render(chunks)
+
+    @raises(ValueError)
+    def test_truncated_body(self):
+        parse_render([self.body[:60]])
+
+
+class TestUtils(object):
+    def test_glob_to_regex(self):
+        for desc, pattern, matches, nonmatches in (
+            ("Star stays within a segment",
+                "a.*.c", ["a.b.c", "a..c"], ["a.b.b.c", "a.b.d"]),
+            ("Question mark",
+                "a.?", ["a.b"], ["a.bb", "a."]),
+            ("Character class",
+                "a[0-2].b", ["a0.b", "a2.b"], ["a3.b"]),
+            ("Negated character class",
+                "a[!0-2]", ["a3"], ["a1"]),
+            ("Braces",
+                "a.{b,c*}.d", ["a.b.d", "a.cat.d"], ["a.e.d", "a.b"]),
+        ):
+            regex = glob_to_regex(pattern)
+            result = (
+                [bool(regex.match(x)) for x in matches + nonmatches]
+            )
+            eq_.description = desc
+            yield eq_, result, [True] * len(matches) + [False] * len(nonmatches)
+            del eq_.description
+
 
 def cmp_metrics(dict1, dict2):
     for metricname, metric in dict1.items():
@@ -186,6 +1275,82 @@ class TestConfig(object):
         aliased_metric = config.groups['group1']['metric1']
         eq_(aliased_metric.path, "foo.bar")
 
+    def test_identical_metrics_are_shared(self):
+        """
+        Each distinct metric definition becomes just one Metric object
+        """
+        config = conf("shared")
+        group1, group2 = config.groups['group1'], config.groups['group2']
+        frontends, backends = map(
+            config.collections['web']['groups'].get,
+            ('frontends', 'backends')
+        )
+        ok_(group1['load.*'] is group2['load.*'] is frontends['metrics'][0])
+        ok_(group1['disk'] is config.metrics['disk'] is frontends['overview'][0])
+        cpu1 = frontends['metrics'][1]
+        cpu2, other = backends['metrics']
+        ok_(cpu1 is cpu2)
+        ok_(other is not cpu1)
+        eq_(cpu1.to_expand, [1])
+        eq_(other.to_expand, ())
+
+
+def support_text(name):
+    with open(os.path.join(os.path.dirname(__file__), "support",
+        name + ".yml")) as fd:
+        return fd.read()
+
+
+class TestConfigReload(object):
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "config.yml")
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, text, mtime):
+        with open(self.path, 'w') as fd:
+            fd.write(text)
+        os.utime(self.path, (mtime, mtime))
+
+    def test_unchanged_graphite_is_carried_over(self):
+        text = support_text("basic")
+        old = Config(text)
+        new = Config(text.replace("-7days", "-8days"), old)
+        eq_(new.periods['week'], "-8days")
+        ok_(new.graphite is old.graphite)
+
+    def test_changed_graphite_is_replaced(self):
+        text = support_text("basic")
+        old = Config(text)
+        new = Config(text.replace("whatever", "elsewhere"), old)
+        ok_(new.graphite is not old.graphite)
+        eq_(new.graphite.uri, "elsewhere")
+
+    def test_reloads_only_when_file_changes(self):
+        text = support_text("basic")
+        self.write(text, 1000)
+        watched = ConfigFile(self.path)
+        first = watched.config
+        watched.refresh()
+        ok_(watched.config is first)
+        self.write(text.replace("-7days", "-8days"), 2000)
+        watched.refresh()
+        ok_(watched.config is not first)
+        eq_(watched.config.periods['week'], "-8days")
+
+    def test_broken_file_keeps_previous_config(self):
+        self.write(support_text("basic"), 1000)
+        watched = ConfigFile(self.path)
+        first = watched.config
+        self.write(support_text("no_url"), 2000)
+        try:
+            watched.refresh()
+        except ValueError:
+            pass
+        ok_(watched.config is first)
+
 
 if __name__ == '__main__':
     main()